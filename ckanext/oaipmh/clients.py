@@ -0,0 +1,246 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import email.utils
+import json
+import logging
+import random
+import threading
+import time
+import urlparse
+
+import oaipmh.client
+import requests
+import requests.adapters
+
+log = logging.getLogger(__name__)
+
+USER_AGENT = 'ckanext-oaipmh'
+REQUEST_TIMEOUT = 300
+POOL_SIZE = 10
+MAX_CACHED_CLIENTS = 64
+
+# Retrying of failed requests: HTTP statuses worth retrying, default number
+# of retries and base delay in seconds of the exponential backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_BACKOFF = 2.0
+MAX_DELAY = 600
+
+# When the repository asks to slow down, the request rate is halved, but not
+# below this fraction of the configured rate. Each successful request then
+# returns this fraction of the configured rate.
+MIN_RATE_FRACTION = 0.1
+RECOVERY_FRACTION = 0.05
+
+_lock = threading.Lock()
+_sessions = {}
+_schedulers = {}
+_clients = {}
+
+
+def _session_for(base_url):
+    ''' Return the HTTP session shared by all clients of a host '''
+    host = urlparse.urlsplit(base_url).netloc
+    session = _sessions.get(host)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = USER_AGENT
+        _sessions[host] = session
+    return session
+
+
+class RequestScheduler(object):
+    ''' Schedules the requests made to one host.
+
+    Requests are limited to a rate with a token bucket, if a rate is given.
+    When the host answers that it is overloaded, all requests to it are
+    paused for the requested time and the rate is lowered, after which it
+    recovers gradually with each successful request.
+    '''
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.max_rate = None
+        self.rate = None
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.paused_until = 0
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.max_rate = float(rate) if rate else None
+            self.rate = self.max_rate
+
+    def acquire(self):
+        ''' Wait until a request may be made '''
+        while True:
+            with self.lock:
+                now = time.time()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if not self.rate:
+                        return
+                    capacity = max(1.0, self.rate)
+                    self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self, delay):
+        ''' Pause requests for delay seconds and lower the rate '''
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + delay)
+            if self.rate:
+                self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+
+    def recover(self):
+        ''' Raise a lowered rate after a successful request '''
+        with self.lock:
+            if self.rate and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_FRACTION)
+
+
+def _scheduler_for(base_url, rate=None):
+    ''' Return the request scheduler shared by all clients of a host '''
+    host = urlparse.urlsplit(base_url).netloc
+    scheduler = _schedulers.get(host)
+    if scheduler is None:
+        scheduler = RequestScheduler(rate)
+        _schedulers[host] = scheduler
+    elif rate and scheduler.max_rate != float(rate):
+        scheduler.set_rate(rate)
+    return scheduler
+
+
+def backoff_delay(attempt, base):
+    ''' Exponential backoff delay with full jitter for a retry attempt '''
+    return random.uniform(0, min(MAX_DELAY, base * 2 ** attempt))
+
+
+def retry_after(response):
+    ''' Return the delay in seconds asked by a Retry-After header, or None '''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        delay = int(value)
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        delay = email.utils.mktime_tz(date) - time.time()
+    return min(MAX_DELAY, max(0, delay))
+
+
+class PooledClient(oaipmh.client.Client):
+    ''' OAI-PMH client making its requests over keep-alive connections.
+
+    Connections are pooled per host, so clients of sources in the same
+    repository share them. The requests to a host are rate limited by a
+    shared :class:`RequestScheduler`, and failed requests are retried with
+    exponential backoff, or after the time asked by the host. URLs other
+    than HTTP(S) ones are read the same way as with
+    :class:`oaipmh.client.Client`.
+    '''
+
+    def __init__(self, base_url, metadata_registry=None, session=None, scheduler=None,
+                 max_retries=DEFAULT_MAX_RETRIES, retry_backoff=DEFAULT_RETRY_BACKOFF):
+        oaipmh.client.Client.__init__(self, base_url, metadata_registry, force_http_get=True)
+        self._session = session or _session_for(base_url)
+        self._scheduler = scheduler or RequestScheduler()
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+
+    def makeRequest(self, **kw):
+        if not self._base_url.startswith(('http://', 'https://')):
+            return oaipmh.client.Client.makeRequest(self, **kw)
+
+        attempt = 0
+        while True:
+            self._scheduler.acquire()
+            try:
+                response = self._session.get(self._base_url, params=kw, timeout=REQUEST_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                delay = backoff_delay(attempt, self._retry_backoff)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    self._scheduler.recover()
+                    return response.content
+                error = requests.HTTPError('{0} {1}'.format(response.status_code, response.reason),
+                                           response=response)
+                delay = retry_after(response)
+                if delay is None:
+                    delay = backoff_delay(attempt, self._retry_backoff)
+                if response.status_code in THROTTLE_STATUSES:
+                    self._scheduler.throttle(delay)
+
+            if attempt >= self._max_retries:
+                raise error
+            attempt += 1
+            log.warning('Request to %s failed: %s. Retrying in %.1f seconds (%d/%d)',
+                        self._base_url, error, delay, attempt, self._max_retries)
+            time.sleep(delay)
+
+
+def get_client(base_url, config, registry_factory, kind='default', md_format=None):
+    ''' Return a cached client for a harvest source.
+
+    Clients are cached per process by source URL, source configuration,
+    kind and metadata format, so that the metadata registry and the
+    connections are reused between harvest objects.
+
+    Configuration options used:
+
+    - requests_per_second: maximum request rate to the host of the source
+    - max_retries: how many times a failed request is retried
+    - retry_backoff: base delay in seconds between retries, doubled on each
+      retry
+
+    :param base_url: OAI-PMH base URL of the source
+    :param config: harvest source configuration dict
+    :param registry_factory: function returning the metadata registry to
+                             use, called when a new client is created
+    :param kind: name separating clients with different registries
+    :param md_format: metadata format of the harvester, separating the
+                      registries of harvesters of different formats
+    :returns: client for the source
+    :rtype: PooledClient
+    '''
+    # Parsed source configurations carry a hash of the configuration
+    key = (base_url, getattr(config, 'digest', None) or json.dumps(config, sort_keys=True), kind, md_format)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            if len(_clients) >= MAX_CACHED_CLIENTS:
+                _clients.clear()
+            client = PooledClient(base_url, registry_factory(), _session_for(base_url),
+                                  _scheduler_for(base_url, config.get('requests_per_second')),
+                                  max_retries=int(config.get('max_retries', DEFAULT_MAX_RETRIES)),
+                                  retry_backoff=float(config.get('retry_backoff', DEFAULT_RETRY_BACKOFF)))
+            _clients[key] = client
+        return client
+
+
+def clear_clients():
+    ''' Forget all cached clients and close their connections '''
+    with _lock:
+        _clients.clear()
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _schedulers.clear()
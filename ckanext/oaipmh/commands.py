@@ -0,0 +1,73 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import sys
+
+from ckan import plugins as p
+from ckan.lib.cli import CkanCommand
+
+
+class OAIPMHCommand(CkanCommand):
+    '''OAI-PMH harvester commands
+
+    Usage:
+
+      oaipmh import {job-id} [--batch-size=N]
+        - Import the objects of a harvest job which have not been imported
+          yet, committing N objects at a time (default import_batch_size of
+          the source configuration). Stop the harvest consumers of the job
+          first.
+
+      oaipmh create-index
+        - Create the index on the source, identifier and current flag of
+          harvest objects, concurrently on PostgreSQL.
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 1
+    max_args = 2
+
+    def __init__(self, name):
+        super(OAIPMHCommand, self).__init__(name)
+        self.parser.add_option('-b', '--batch-size', dest='batch_size', type='int', default=None,
+                               help='Number of harvest objects committed at a time')
+
+    def command(self):
+        self._load_config()
+        cmd = self.args[0]
+        if cmd == 'import' and len(self.args) == 2:
+            self.import_job(self.args[1])
+        elif cmd == 'create-index':
+            self.create_index()
+        else:
+            print 'Command {0} not recognized'.format(cmd)
+            sys.exit(1)
+
+    def import_job(self, job_id):
+        from ckanext.harvest.interfaces import IHarvester
+        from ckanext.harvest.model import HarvestJob
+
+        harvest_job = HarvestJob.get(job_id)
+        if not harvest_job:
+            print 'Harvest job {0} not found'.format(job_id)
+            sys.exit(1)
+        for harvester in p.PluginImplementations(IHarvester):
+            if harvester.info()['name'] == harvest_job.source.type and hasattr(harvester, 'import_job'):
+                imported = harvester.import_job(harvest_job, self.options.batch_size)
+                print 'Imported {0} harvest objects'.format(imported)
+                return
+        print 'No OAI-PMH harvester for source type {0}'.format(harvest_job.source.type)
+        sys.exit(1)
+
+    def create_index(self):
+        from ckanext.oaipmh import model as oaipmh_model
+
+        if oaipmh_model.create_harvest_object_index():
+            print 'Created index {0}'.format(oaipmh_model.HARVEST_OBJECT_INDEX)
+        else:
+            print 'Index {0} exists already'.format(oaipmh_model.HARVEST_OBJECT_INDEX)
@@ -5,121 +5,580 @@
 # :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
 # :license: GNU Affero General Public License version 3
 
+import datetime
+import itertools
 import logging
-import json
 
 import oaipmh.client
-import oaipmh.error
+import oaipmh.metadata
+import lxml.etree
 
 import importformats
+import clients
+import indexing
+import listing
+import prefetch
+import serialization
+import source_config
 
 from ckan.model import Session
+from ckan.model.types import make_uuid
 from ckan import model
 from ckan import plugins as p
-from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestObjectExtra as HOExtra
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestObjectError, HarvestObjectExtra as HOExtra
 from ckanext.harvest.harvesters.base import HarvesterBase
 
 from ckanext.etsin.data_catalog_service import ensure_data_catalog_ok
-
-import fnmatch
-import re
+from ckanext.oaipmh import model as oaipmh_model
+from ckanext.oaipmh.model import OAIPMHHarvestState, OAIPMHGatherRecord
+from ckanext.oaipmh.incremental import HarvestWindow, promote_high_water_marks
 
 log = logging.getLogger(__name__)
 
+OAI_NAMESPACES = {'oai': 'http://www.openarchives.org/OAI/2.0/'}
+
+# Gather modes. In 'identifiers' mode gather lists record identifiers and
+# import stage requests each record separately. In 'records' mode gather
+# lists whole records and stores them on the harvest objects.
+GATHER_MODE_IDENTIFIERS = 'identifiers'
+GATHER_MODE_RECORDS = 'records'
+
+# Largest fraction of harvested records that may be deleted as missing from
+# the source in one harvest
+DEFAULT_DELETE_MISSING_MAX_FRACTION = 0.1
+
+# Value of force_harvest_update which updates datasets even when their
+# content has not changed
+FORCE_UPDATE_ALWAYS = 'always'
+
+# Number of harvest objects committed at a time by import_objects
+DEFAULT_IMPORT_BATCH_SIZE = 100
+
 
 class OAIPMHHarvester(HarvesterBase):
     '''
     OAI-PMH Harvester
     '''
+    p.implements(p.IConfigurable)
+
+    # Whether import stage is run by import_objects, which commits the
+    # imported objects in batches
+    _batch_import = False
+    # Records of the current import batch read in advance, by harvest object id
+    _prepared_records = None
+
+    def configure(self, config):
+        ''' Set up the database tables of the OAI-PMH harvester '''
+        oaipmh_model.setup()
 
     def _get_configuration(self, harvest_job):
-        """ Parse configuration from given harvest object """
-        configuration = {}
-        if harvest_job.source.config:
-            log.debug('Config: %s', harvest_job.source.config)
-            try:
-                configuration = json.loads(harvest_job.source.config)
-            except ValueError as e:
-                self._save_gather_error('Gather: Unable to decode config from: {c}, {e}'.
-                                        format(e=e, c=harvest_job.source.config), harvest_job)
-                raise
-        return configuration
+        """ Parse configuration from given harvest object.
+
+        The parsed configuration is cached by source, see :func:`source_config.get`.
+        """
+        try:
+            return source_config.get(harvest_job.source.id, harvest_job.source.config)
+        except ValueError as e:
+            self._save_gather_error('Gather: Unable to decode config from: {c}, {e}'.
+                                    format(e=e, c=harvest_job.source.config), harvest_job)
+            raise
+
+    def validate_config(self, config):
+        """ Check the configuration of a harvest source when it is saved """
+        source_config.parse(config)
+        return config
 
     def metadata_registry(self, config, harvest_job):
         harvest_type = config.get('type', 'default')
         return importformats.create_metadata_registry(harvest_type, harvest_job.source.url)
 
-    def get_record_identifiers(self, set_ids, client):
-        ''' Get package identifiers from given set identifiers.
+    def get_client(self, config, harvest_job):
+        ''' Get a cached OAI-PMH client for the source of a harvest job or object '''
+        return clients.get_client(harvest_job.source.url, config,
+                                  lambda: self.metadata_registry(config, harvest_job), md_format=self.md_format)
+
+    def get_raw_client(self, config, harvest_job):
+        ''' Get a cached OAI-PMH client returning the metadata of the
+        harvester's format unparsed, see :meth:`raw_metadata_registry` '''
+        return clients.get_client(harvest_job.source.url, config, self.raw_metadata_registry,
+                                  kind='raw', md_format=self.md_format)
+
+    def _harvest_window(self, harvest_job, config):
+        ''' Create the datestamp window of a harvest job, after promoting
+        the high-water marks of the source's earlier jobs which have finished '''
+        promote_high_water_marks(harvest_job.source.id)
+        model.Session.commit()
+        return HarvestWindow(harvest_job.source.id, config)
+
+    def gather_records(self, harvest_job, set_ids, config, window, client, streaming=False):
+        ''' List the records of the source, or of the given sets.
+
+        Sets are listed concurrently by gather_workers threads. With
+        gather_checkpoints the listed records and the resumption token of
+        each set are stored after each page, and a gather which has been
+        interrupted continues from the stored tokens.
+
+        :param streaming: only store the listed records in the staging table
+                          instead of collecting them in memory
+        :returns: dict from record identifier to (datestamp, deleted, record)
+                  tuples, where record is the serialized OAI-PMH record in
+                  records gather mode and None otherwise, or None when
+                  streaming
         '''
-
-        kwargs = {}
-        kwargs['metadataPrefix'] = self.md_format
-
-        if set_ids:
-            for set_id in set_ids:
+        source_id = harvest_job.source.id
+        if config.get('gather_mode', GATHER_MODE_IDENTIFIERS) == GATHER_MODE_RECORDS:
+            verb = listing.LIST_RECORDS
+            client = self.get_raw_client(config, harvest_job)
+        else:
+            verb = listing.LIST_IDENTIFIERS
+        window.configure_client(client)
+        checkpoints = config.get('gather_checkpoints', False)
+        if streaming and not checkpoints:
+            OAIPMHGatherRecord.clear(source_id)
+            model.Session.commit()
+
+        records = {}
+        tasks = []
+        for set_id in sorted(set_ids) or [None]:
+            kwargs = {}
+            kwargs['metadataPrefix'] = self.md_format
+            if set_id is not None:
                 kwargs['set'] = set_id
-                try:
-                    for header in client.listIdentifiers(**kwargs):
-                        yield header.identifier()
-                except oaipmh.error.NoRecordsMatchError:
-                    pass
+            kwargs.update(window.list_kwargs(set_id))
+            resumption_token = None
+            if checkpoints:
+                state = OAIPMHHarvestState.get_for(source_id, set_id)
+                if state and (state.listing_done or state.resumption_token):
+                    log.info('Continuing interrupted listing of set %s', set_id)
+                    if not streaming:
+                        for record in OAIPMHGatherRecord.for_set(source_id, set_id):
+                            window.observe(set_id, record.datestamp)
+                            records[record.identifier] = (record.datestamp, record.deleted, record.content)
+                    if state.listing_done:
+                        continue
+                    resumption_token = state.resumption_token
+                else:
+                    OAIPMHGatherRecord.clear(source_id, set_id or u'')
+                    model.Session.commit()
+            log.debug('Listing set %s with %s', set_id, kwargs)
+            tasks.append(listing.SetTask(set_id, kwargs, resumption_token))
+
+        workers = int(config.get('gather_workers', 1))
+        for set_id, event, items, token in listing.gather_pages(client, verb, tasks, workers):
+            if event == listing.RESTART:
+                OAIPMHGatherRecord.clear(source_id, set_id or u'')
+                model.Session.commit()
+                continue
+            page = [self._record_tuple(verb, item) for item in items]
+            if checkpoints:
+                self._save_checkpoint(source_id, set_id, page, token)
+            elif streaming:
+                self._stage_page(source_id, set_id, page)
+                model.Session.commit()
+            if streaming:
+                continue
+            for guid, datestamp, deleted, record in page:
+                window.observe(set_id, datestamp)
+                records[guid] = (datestamp, deleted, record)
+
+        if streaming:
+            for set_spec, datestamp in OAIPMHGatherRecord.newest_datestamps(source_id):
+                window.observe(set_spec or None, datestamp)
+            return None
+        return records
+
+    def _record_tuple(self, verb, item):
+        ''' Convert a listed item to (identifier, datestamp, deleted, record) '''
+        if verb == listing.LIST_RECORDS:
+            header = item[0]
+            record = lxml.etree.tostring(header.element().getparent(), encoding=unicode)
         else:
-            try:
-                for header in client.listIdentifiers(**kwargs):
-                    yield header.identifier()
-            except oaipmh.error.NoRecordsMatchError:
-                pass
+            header = item
+            record = None
+        return header.identifier(), header.datestamp(), header.isDeleted(), record
+
+    def _stage_page(self, source_id, set_id, page):
+        ''' Store the records of a listed page in the staging table '''
+        if page:
+            model.Session.execute(oaipmh_model.gather_record_table.insert(), [
+                {'id': make_uuid(), 'harvest_source_id': source_id, 'set_spec': set_id or u'',
+                 'identifier': guid, 'datestamp': datestamp, 'deleted': deleted, 'content': record}
+                for guid, datestamp, deleted, record in page])
+
+    def _save_checkpoint(self, source_id, set_id, page, resumption_token):
+        ''' Store a listed page and the token for continuing after it '''
+        self._stage_page(source_id, set_id, page)
+        state = OAIPMHHarvestState.get_or_create(source_id, set_id)
+        state.resumption_token = resumption_token
+        state.listing_done = resumption_token is None
+        state.add()
+        model.Session.commit()
+
+    def _finish_listing(self, source_id):
+        ''' Forget the checkpoints and the staged records of a finished
+        listing, so that the next gather lists the source again.
+
+        The caller is responsible for committing the session.
+        '''
+        OAIPMHHarvestState.reset_checkpoints(source_id)
+        OAIPMHGatherRecord.clear(source_id)
+
+    def raw_metadata_registry(self):
+        ''' Create a registry which returns metadata elements unparsed '''
+        registry = oaipmh.metadata.MetadataRegistry()
+        registry.registerReader(self.md_format, lambda element: element)
+        return registry
+
+    def read_stored_record(self, harvest_object, registry):
+        ''' Read the OAI-PMH record stored on a harvest object during gather.
 
-    def populate_harvest_job(self, harvest_job, set_ids, client):
+        :param harvest_object: HarvestObject object
+        :param registry: metadata registry used to read the metadata
+        :returns: (header, metadata, about) like ``oaipmh.client.Client.getRecord``,
+                  or None if no record is stored on the object
+        '''
+        parsed = self._parse_stored_record(harvest_object)
+        if parsed is None:
+            return None
+        header, metadata_node = parsed
+        metadata = None
+        if metadata_node is not None:
+            metadata = registry.readMetadata(self.md_format, metadata_node)
+        return header, metadata, None
+
+    def _parse_stored_record(self, harvest_object):
+        ''' Return the header and the metadata element of the record stored
+        on a harvest object, or None if no record is stored on it '''
+        content = harvest_object.content
+        if not content or not content.lstrip().startswith('<'):
+            return None
+
+        record = lxml.etree.fromstring(content.encode('utf-8'))
+        header = oaipmh.client.buildHeader(record.xpath('oai:header', namespaces=OAI_NAMESPACES)[0],
+                                           OAI_NAMESPACES)
+        metadata_nodes = record.xpath('oai:metadata', namespaces=OAI_NAMESPACES)
+        return header, metadata_nodes[0] if metadata_nodes else None
+
+    def _prepare_records(self, harvest_objects):
+        ''' Read the records stored on a batch of harvest objects at once.
+
+        The metadata of the records of each source is read with one call,
+        so that readers and IOAIPMHHarvester plugins mapping many records at
+        a time get the whole batch. Records which cannot be read this way
+        are read again, and their errors reported, in import stage.
+        '''
+        self._prepared_records = {}
+        by_registry = {}
+        for harvest_object in harvest_objects:
+            try:
+                parsed = self._parse_stored_record(harvest_object)
+                if parsed is None:
+                    continue
+                registry = self.get_client(self._get_configuration(harvest_object), harvest_object) \
+                    .getMetadataRegistry()
+            except Exception as e:
+                log.debug('Unable to read record of %s in advance: %s', harvest_object.guid, e)
+                continue
+            if not hasattr(registry, 'readMetadataBatch'):
+                continue
+            by_registry.setdefault(id(registry), (registry, []))[1].append((harvest_object, parsed))
+
+        for registry, parsed_records in by_registry.values():
+            nodes = [node for _, (_, node) in parsed_records if node is not None]
+            try:
+                metadatas = iter(registry.readMetadataBatch(self.md_format, nodes))
+            except Exception as e:
+                log.warning('Unable to read a batch of %d records: %s', len(nodes), e)
+                continue
+            for harvest_object, (header, node) in parsed_records:
+                metadata = next(metadatas) if node is not None else None
+                self._prepared_records[harvest_object.id] = (header, metadata, None)
+
+    def populate_harvest_job(self, harvest_job, set_ids, config, client):
+        ''' Create the harvest objects of a job, comparing the listed records
+        with the current harvest objects of the source in memory.
+
+        The identifiers of all listed records and current harvest objects
+        are kept in memory. In records gather mode, and with gather_streaming
+        for sources with millions of records, the listed records are staged
+        and compared in the database instead, see
+        :meth:`populate_harvest_job_streaming`.
+        '''
+        if config.get('gather_streaming', False) or \
+                config.get('gather_mode', GATHER_MODE_IDENTIFIERS) == GATHER_MODE_RECORDS:
+            return self.populate_harvest_job_streaming(harvest_job, set_ids, config, client)
         url = harvest_job.source.url
         if len(set_ids):
             log.debug('Sets in config: %s', set_ids)
-        # Collect record identifiers
-        guids_in_source = set(self.get_record_identifiers(set_ids, client))
+        window = self._harvest_window(harvest_job, config)
+        # Collect record identifiers with their header datestamps and deleted
+        # flags, and records themselves in records mode
+        records = self.gather_records(harvest_job, set_ids, config, window, client)
+        guids_in_source = set(records)
         try:
-            object_ids = []
             if len(guids_in_source):
-                log.debug('Record identifiers: %s', guids_in_source)
+                log.debug('Listed %d record identifiers', len(guids_in_source))
 
-                harvest_objs_in_db = model.Session.query(HarvestObject.guid, HarvestObject.package_id). \
+                harvest_objs_in_db = model.Session.query(HarvestObject.guid, HarvestObject.package_id,
+                                                         HarvestObject.metadata_modified_date, HarvestObject.id). \
                     filter(HarvestObject.current == True). \
                     filter(HarvestObject.harvest_source_id == harvest_job.source.id)
 
                 db_harvest_obj_guid_to_package_id_map = {}
-                for guid, package_id in harvest_objs_in_db:
+                db_harvest_obj_guid_to_modified_map = {}
+                db_harvest_obj_guid_to_id_map = {}
+                for guid, package_id, modified, object_id in harvest_objs_in_db:
                     db_harvest_obj_guid_to_package_id_map[guid] = package_id
+                    db_harvest_obj_guid_to_modified_map[guid] = modified
+                    db_harvest_obj_guid_to_id_map[guid] = object_id
 
                 current_guids_in_db = set(db_harvest_obj_guid_to_package_id_map.keys())
 
                 new_guids = guids_in_source - current_guids_in_db
                 existing_guids = current_guids_in_db & guids_in_source
 
-                for guid in new_guids:
-                    obj = HarvestObject(guid=guid, job=harvest_job,
-                                        extras=[HOExtra(key='status', value='new')])
-                    obj.save()
-                    object_ids.append(obj.id)
-                for guid in existing_guids:
-                    obj = HarvestObject(guid=guid, job=harvest_job,
-                                        package_id=db_harvest_obj_guid_to_package_id_map[guid],
-                                        extras=[HOExtra(key='status', value='change')])
-                    obj.save()
-                    object_ids.append(obj.id)
-                # Deleted datasets are handled later using object_ids as the list of
-                # identifiers for getting identifiers that are inspected whether they
-                # are deleted.
-
-                log.debug('Harvest object IDs: {i}'.format(i=object_ids))
+                # Records marked deleted in the headers are handled here, so that
+                # they are not requested again in import stage. Deleted records
+                # which have never been harvested need no action at all.
+                deleted_guids = set(guid for guid in guids_in_source if records[guid][1])
+                new_guids -= deleted_guids
+                existing_guids -= deleted_guids
+                deleted_package_ids = dict((guid, db_harvest_obj_guid_to_package_id_map[guid])
+                                           for guid in deleted_guids & current_guids_in_db)
+                # Records which have disappeared from the source without being
+                # marked deleted are only deleted if the whole source was listed
+                if config.get('delete_missing', False) and not window.is_restricted():
+                    missing_guids = current_guids_in_db - guids_in_source
+                    if self._is_safe_to_delete(harvest_job, len(missing_guids), len(current_guids_in_db), config):
+                        deleted_package_ids.update((guid, db_harvest_obj_guid_to_package_id_map[guid])
+                                                   for guid in missing_guids)
+                if deleted_package_ids:
+                    self.delete_packages(harvest_job, deleted_package_ids, config)
+
+                # Records whose datestamp is not newer than that of the current
+                # harvest object are unchanged and need no harvest object
+                if not config.get('force_harvest_update', False):
+                    unchanged_guids = set(guid for guid in existing_guids
+                                          if self._is_unchanged(records[guid][0],
+                                                                db_harvest_obj_guid_to_modified_map[guid]))
+                    if unchanged_guids:
+                        log.info('Skipping %d unchanged records', len(unchanged_guids))
+                        existing_guids -= unchanged_guids
+
+                # Objects are created, and so queued, in the order of their
+                # identifiers, in which fetch stage also fetches them ahead
+                def harvest_objects():
+                    for guid in sorted(new_guids | existing_guids):
+                        datestamp, _deleted, record = records[guid]
+                        if guid in new_guids:
+                            yield {'guid': guid, 'content': record, 'metadata_modified_date': datestamp,
+                                   'extras': {'status': 'new'}}
+                        else:
+                            yield {'guid': guid, 'content': record, 'metadata_modified_date': datestamp,
+                                   'package_id': db_harvest_obj_guid_to_package_id_map[guid],
+                                   'extras': {'status': 'change',
+                                              'previous_object_id': db_harvest_obj_guid_to_id_map[guid]}}
+
+                object_ids = oaipmh_model.bulk_create_harvest_objects(
+                    harvest_job, harvest_objects(),
+                    chunk_size=config.get('gather_chunk_size', oaipmh_model.DEFAULT_CHUNK_SIZE),
+                    use_copy=config.get('gather_use_copy', False))
+
+                # Remember the newest datestamps for the next incremental harvest,
+                # and commit them together with the harvest objects
+                window.save(harvest_job.id)
+                if config.get('gather_checkpoints', False):
+                    self._finish_listing(harvest_job.source.id)
+                model.Session.commit()
+
+                log.debug('Created %d harvest objects', len(object_ids))
                 return object_ids
-            else:
-                self._save_gather_error('No records received from URL: {u}'.format(
-                    u=url), harvest_job)
+
+            if config.get('gather_checkpoints', False):
+                self._finish_listing(harvest_job.source.id)
+                model.Session.commit()
+            if window.is_restricted():
+                log.info('No records changed in URL: {u}'.format(u=url))
+                return []
+            self._save_gather_error('No records received from URL: {u}'.format(
+                u=url), harvest_job)
+            return None
+        except Exception as e:
+            # Do not leave a partially created set of harvest objects behind
+            model.Session.rollback()
+            self._save_gather_error('Gather: {e}'.format(e=e), harvest_job)
+            raise
+
+    def populate_harvest_job_streaming(self, harvest_job, set_ids, config, client):
+        ''' Create the harvest objects of a job without keeping the listed
+        records or the current harvest objects in memory.
+
+        The listed records are stored in the staging table page by page, and
+        compared with the current harvest objects of the source with SQL.
+        Used with gather_streaming, and always in records gather mode.
+        '''
+        source_id = harvest_job.source.id
+        url = harvest_job.source.url
+        window = self._harvest_window(harvest_job, config)
+        self.gather_records(harvest_job, set_ids, config, window, client, streaming=True)
+        set_specs = [set_id or u'' for set_id in sorted(set_ids) or [None]]
+        chunk_size = config.get('gather_chunk_size', oaipmh_model.DEFAULT_CHUNK_SIZE)
+        try:
+            if not oaipmh_model.has_staged_records(source_id, set_specs):
+                self._finish_listing(source_id)
+                model.Session.commit()
+                if window.is_restricted():
+                    log.info('No records changed in URL: {u}'.format(u=url))
+                    return []
+                self._save_gather_error('No records received from URL: {u}'.format(u=url), harvest_job)
                 return None
+
+            # Records marked deleted in the headers, and records which have
+            # disappeared from the source if the whole source was listed
+            deleted_package_ids = dict(oaipmh_model.staged_deleted_objects(source_id, set_specs))
+            if config.get('delete_missing', False) and not window.is_restricted():
+                missing = oaipmh_model.missing_objects(source_id, set_specs)
+                current_count = model.Session.query(HarvestObject.id) \
+                    .filter(HarvestObject.current == True) \
+                    .filter(HarvestObject.harvest_source_id == source_id) \
+                    .count()
+                if self._is_safe_to_delete(harvest_job, missing.count(), current_count, config):
+                    deleted_package_ids.update(missing)
+            if deleted_package_ids:
+                self.delete_packages(harvest_job, deleted_package_ids, config)
+
+            force_harvest_update = config.get('force_harvest_update', False)
+            unchanged = [0]
+
+            def harvest_objects():
+                for guid, datestamp, deleted, record, object_id, package_id, modified in \
+                        oaipmh_model.staged_records(source_id, set_specs, chunk_size):
+                    if deleted:
+                        continue
+                    if object_id is None:
+                        yield {'guid': guid, 'content': record, 'metadata_modified_date': datestamp,
+                               'extras': {'status': 'new'}}
+                    elif force_harvest_update or not self._is_unchanged(datestamp, modified):
+                        yield {'guid': guid, 'content': record, 'metadata_modified_date': datestamp,
+                               'package_id': package_id,
+                               'extras': {'status': 'change', 'previous_object_id': object_id}}
+                    else:
+                        unchanged[0] += 1
+
+            object_ids = oaipmh_model.bulk_create_harvest_objects(
+                harvest_job, harvest_objects(), chunk_size=chunk_size,
+                use_copy=config.get('gather_use_copy', False))
+            if unchanged[0]:
+                log.info('Skipping %d unchanged records', unchanged[0])
+
+            window.save(harvest_job.id)
+            self._finish_listing(source_id)
+            model.Session.commit()
+
+            log.debug('Created %d harvest objects', len(object_ids))
+            return object_ids
         except Exception as e:
+            model.Session.rollback()
             self._save_gather_error('Gather: {e}'.format(e=e), harvest_job)
             raise
 
+    def delete_packages(self, harvest_job, guid_to_package_id, config):
+        ''' Delete the packages of records which no longer exist in the source.
+
+        The current harvest objects of the records are flagged as not current,
+        and a completed harvest object with report status 'deleted' is
+        created for each record so that the deletions show in the job report.
+
+        :param harvest_job: HarvestJob object
+        :param guid_to_package_id: dict from record identifier to package id
+        :param config: harvest source configuration
+        '''
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': 'harvest',
+            'ignore_auth': True,
+        }
+        if config.get('harvest_source_name', False):
+            context['harvest_source_name'] = config.get('harvest_source_name')
+
+        for guid, package_id in guid_to_package_id.items():
+            try:
+                p.toolkit.get_action('package_delete')(context.copy(), {'id': package_id})
+                log.info('Deleted package with id {0}'.format(package_id))
+            except p.toolkit.ObjectNotFound:
+                log.debug('Tried to delete package with id {0}, but could not find it'.format(package_id))
+
+        chunk_size = config.get('gather_chunk_size', oaipmh_model.DEFAULT_CHUNK_SIZE)
+        guids = list(guid_to_package_id)
+        for start in range(0, len(guids), chunk_size):
+            model.Session.query(HarvestObject) \
+                .filter(HarvestObject.harvest_source_id == harvest_job.source.id) \
+                .filter(HarvestObject.current == True) \
+                .filter(HarvestObject.guid.in_(guids[start:start + chunk_size])) \
+                .update({'current': False}, synchronize_session=False)
+
+        oaipmh_model.bulk_create_harvest_objects(
+            harvest_job,
+            ({'guid': guid, 'package_id': package_id, 'state': u'COMPLETE', 'report_status': u'deleted',
+              'extras': {'status': 'delete'}}
+             for guid, package_id in guid_to_package_id.items()),
+            chunk_size=chunk_size)
+        model.Session.commit()
+
+    def _is_safe_to_delete(self, harvest_job, missing_count, current_count, config):
+        ''' Check that missing records are not too large a part of the source.
+
+        A large amount of missing records more likely means a problem in the
+        source than that the records have really been removed.
+        '''
+        if not missing_count:
+            return False
+        max_fraction = float(config.get('delete_missing_max_fraction', DEFAULT_DELETE_MISSING_MAX_FRACTION))
+        fraction = float(missing_count) / current_count
+        if fraction > max_fraction:
+            self._save_gather_error(
+                'Gather: {n} of {t} records are missing from the source, which is more than the allowed '
+                'fraction {f}. Not deleting them.'.format(n=missing_count, t=current_count,
+                                                          f=max_fraction), harvest_job)
+            return False
+        log.info('Deleting %d records missing from the source', missing_count)
+        return True
+
+    def _is_unchanged(self, datestamp, previous_datestamp):
+        ''' Tell whether a record datestamp is not newer than the previous one '''
+        return bool(datestamp and previous_datestamp and datestamp <= previous_datestamp)
+
+    def _has_same_content(self, harvest_object, previous_object):
+        ''' Compare the content digests of a harvest object and its previous object '''
+        previous_digest = self._get_object_extra(previous_object, 'content_hash')
+        if previous_digest is None and previous_object.content:
+            # Objects harvested before digests were stored
+            try:
+                previous_digest = serialization.package_digest(
+                    serialization.loads(serialization.decode_content(previous_object.content)))
+            except ValueError:
+                return False
+        return previous_digest is not None and \
+            previous_digest == self._get_object_extra(harvest_object, 'content_hash')
+
+    def _get_previous_object(self, harvest_object):
+        ''' Return the current harvest object of the same record, or None.
+
+        The object is looked up by the id gathered in gather stage, and
+        queried by identifier only for objects gathered without it.
+        '''
+        previous_object_id = self._get_object_extra(harvest_object, 'previous_object_id')
+        if previous_object_id:
+            previous_object = HarvestObject.get(previous_object_id)
+            if previous_object and previous_object.current and previous_object.guid == harvest_object.guid:
+                return previous_object
+        return model.Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_source_id == harvest_object.harvest_source_id) \
+            .filter(HarvestObject.guid == harvest_object.guid) \
+            .filter(HarvestObject.current == True) \
+            .first()
+
     def _get_object_extra(self, harvest_object, key):
         '''
         Helper function for retrieving the value from a harvest object extra,
@@ -130,6 +589,18 @@ class OAIPMHHarvester(HarvesterBase):
                 return extra.value
         return None
 
+    def _set_object_extra(self, harvest_object, key, value):
+        ''' Set the value of a harvest object extra, replacing any existing
+        extras with the same key '''
+        extras = [extra for extra in harvest_object.extras if extra.key == key]
+        for extra in extras[1:]:
+            harvest_object.extras.remove(extra)
+            model.Session.delete(extra)
+        if extras:
+            extras[0].value = value
+        else:
+            harvest_object.extras.append(HOExtra(key=key, value=value))
+
     def gather_stage(self, harvest_job):
         '''
         The gather stage will receive a HarvestJob object and will be
@@ -158,31 +629,41 @@ class OAIPMHHarvester(HarvesterBase):
         if not ensure_data_catalog_ok(config.get('harvest_source_name', '')):
             return []
 
+        if config.get('object_retention_days') is not None:
+            self.prune_harvest_objects(harvest_job, config)
+
         # Create a OAI-PMH Client
-        registry = self.metadata_registry(config, harvest_job)
-        client = oaipmh.client.Client(harvest_job.source.url, registry, force_http_get=True)
+        client = self.get_client(config, harvest_job)
 
         available_sets = list(client.listSets())
 
         log.debug('Available sets: %s', available_sets)
 
-        set_ids = set()
-        for set_id in config.get('set', []):
-            if '*' in set_id:
-                matcher = re.compile(fnmatch.translate(set_id))
-                found = False
-                for set_spec, _, _ in available_sets:
-                    if matcher.match(set_spec):
-                        set_ids.add(set_spec)
-                        found = True
-                if not found:
-                    log.warning("No sets found with given wildcard string: %s", set_id)
-            else:
-                if not any(set_id in sets for sets in available_sets):
-                    log.warning("Given set %s is not in available sets. Not removing.", set_id)
-                set_ids.add(set_id)
+        set_ids, unlisted, unmatched = config.set_matcher.match(available_sets)
+        for set_id in unmatched:
+            log.warning("No sets found with given wildcard string: %s", set_id)
+        for set_id in unlisted:
+            log.warning("Given set %s is not in available sets. Not removing.", set_id)
 
-        return self.populate_harvest_job(harvest_job, set_ids, client)
+        return self.populate_harvest_job(harvest_job, set_ids, config, client)
+
+    def prune_harvest_objects(self, harvest_job, config):
+        ''' Delete the source's harvest objects which are no longer current
+        and older than object_retention_days.
+
+        :param harvest_job: HarvestJob object
+        :param config: harvest source configuration
+        '''
+        older_than = datetime.datetime.utcnow() - datetime.timedelta(days=float(config['object_retention_days']))
+        try:
+            deleted = oaipmh_model.prune_harvest_objects(
+                harvest_job.source.id, older_than,
+                chunk_size=config.get('gather_chunk_size', oaipmh_model.DEFAULT_CHUNK_SIZE))
+            model.Session.commit()
+            log.info('Pruned %d harvest objects gathered before %s', deleted, older_than)
+        except Exception as e:
+            model.Session.rollback()
+            log.warning('Unable to prune old harvest objects: %s', e)
 
     def fetch_stage(self, harvest_object):
         '''
@@ -196,8 +677,38 @@ class OAIPMHHarvester(HarvesterBase):
         :param harvest_object: HarvestObject object
         :returns: True if everything went right, False if errors were found
         '''
+        # Records listed with ListRecords are stored already in gather stage
+        if harvest_object.content:
+            return True
+
+        config = self._get_configuration(harvest_object)
+        try:
+            client = self.get_raw_client(config, harvest_object)
+            concurrency = int(config.get('fetch_concurrency', 1))
+            if concurrency > 1:
+                prefetcher = prefetch.get_prefetcher(harvest_object.source.id, concurrency)
+                content = prefetcher.fetch(harvest_object, lambda guid: self.fetch_record(client, guid))
+            else:
+                content = self.fetch_record(client, harvest_object.guid)
+        except Exception as e:
+            self._save_object_error('Unable to get metadata from provider: {u}: {e}'.format(
+                u=harvest_object.source.url, e=e), harvest_object, 'Fetch')
+            return False
+
+        harvest_object.content = content
+        harvest_object.save()
         return True
 
+    def fetch_record(self, client, identifier):
+        ''' Get a serialized OAI-PMH record with GetRecord.
+
+        :param client: client using a registry created with :meth:`raw_metadata_registry`
+        :param identifier: record identifier
+        :returns: the record element serialized, as stored by :meth:`get_records`
+        '''
+        header, _metadata, _about = client.getRecord(identifier=identifier, metadataPrefix=self.md_format)
+        return lxml.etree.tostring(header.element().getparent(), encoding=unicode)
+
     def import_stage(self, harvest_object):
         '''
         The import stage will receive a HarvestObject object and will be
@@ -210,33 +721,61 @@ class OAIPMHHarvester(HarvesterBase):
         - creating and storing any suitable HarvestObjectErrors that may occur.
         - returning True if everything went as expected, False otherwise.
 
+        With defer_indexing in the source configuration, the packages are
+        not indexed when they are created or updated, but in batches. With
+        incremental, the high-water marks listed by the job are stored for
+        the next harvest when its last object has been imported.
+
         :param harvest_object: HarvestObject object
         :returns: True if everything went right, False if errors were found
         '''
-
-        log.debug('Import stage for harvest object with guid: %s', harvest_object.guid)
-
         if not harvest_object:
             log.error('No harvest object received')
             return False
 
+        config = self._get_configuration(harvest_object)
+        if config.get('defer_indexing', False):
+            with indexing.deferred():
+                success = self._import_stage(harvest_object)
+            # Bulk imports index their packages after committing them. The
+            # pending packages are indexed when the job's last object has been
+            # imported, whether or not that object succeeded.
+            if not self._batch_import:
+                indexing.reindex_if_due(harvest_object,
+                                        int(config.get('index_batch_size', indexing.DEFAULT_BATCH_SIZE)))
+        else:
+            success = self._import_stage(harvest_object)
+
+        # The high-water marks of the job are used once all its objects
+        # have been imported
+        if config.get('incremental', False):
+            promote_high_water_marks(harvest_object.source.id, harvest_object, success)
+            self._commit()
+        return success
+
+    def _import_stage(self, harvest_object):
+        log.debug('Import stage for harvest object with guid: %s', harvest_object.guid)
+
         config = self._get_configuration(harvest_object)
 
         context = {
             'model': model,
             'session': model.Session,
             'user': 'harvest',
+            'defer_commit': self._batch_import,
         }
 
         status = self._get_object_extra(harvest_object, 'status')
 
-        # Get metadata content from provider
+        # Get metadata content stored during gather, or from provider
         try:
-            # Create a OAI-PMH Client and get record
-            registry = self.metadata_registry(config, harvest_object)
-            client = oaipmh.client.Client(harvest_object.job.source.url, registry, force_http_get=True)
-            header, metadata, _about = client.getRecord(identifier=harvest_object.guid,
-                                                        metadataPrefix=self.md_format)
+            client = self.get_client(config, harvest_object)
+            record = (self._prepared_records or {}).pop(harvest_object.id, None)
+            if record is None:
+                record = self.read_stored_record(harvest_object, client.getMetadataRegistry())
+            if record is None:
+                record = client.getRecord(identifier=harvest_object.guid, metadataPrefix=self.md_format)
+            header, metadata, _about = record
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -251,7 +790,12 @@ class OAIPMHHarvester(HarvesterBase):
         if header and header.isDeleted():
             harvest_object.content = None
             harvest_object.report_status = "delete"
-            harvest_object.save()
+            harvest_object.add()
+            # The deleted package is removed from the search index in the
+            # next batch, when indexing is deferred
+            if harvest_object.package_id and config.get('defer_indexing', False):
+                indexing.mark_pending(harvest_object)
+            self._commit()
 
             # Delete package
             try:
@@ -272,11 +816,15 @@ class OAIPMHHarvester(HarvesterBase):
             # Stop processing when some identifier is marked as deleted
             return True
 
-        # Get contents
+        # Get contents. The mapped package dict is serialized only for
+        # storing, and used as such for creating or updating the package.
         try:
-            content = json.dumps(metadata.getMap())
-            # Save the fetched contents in the HarvestObject
-            harvest_object.content = content
+            package_dict = metadata.getMap()
+            content = serialization.dumps(package_dict)
+            # Save the fetched contents in the HarvestObject, with a digest
+            # for detecting updates which do not change anything
+            harvest_object.content = serialization.compress_content(content, config.get('content_compression'))
+            self._set_object_extra(harvest_object, 'content_hash', serialization.content_digest(content))
             harvest_object.add()
         except Exception as e:
             import traceback
@@ -289,13 +837,9 @@ class OAIPMHHarvester(HarvesterBase):
             self._save_object_error('Empty content for object {0}'.format(harvest_object.id), harvest_object, 'Import')
             return False
 
-        previous_object = model.Session.query(HarvestObject) \
-            .filter(HarvestObject.guid == harvest_object.guid) \
-            .filter(HarvestObject.current == True) \
-            .first()
+        previous_object = self._get_previous_object(harvest_object)
 
-        # Get mapped package_dict and move source data to context
-        package_dict = json.loads(harvest_object.content)
+        # Move source data to context
         context.update({
             'source_data': metadata.element(),
             'return_id_only': True
@@ -315,7 +859,7 @@ class OAIPMHHarvester(HarvesterBase):
                     # Delete the previous object to avoid cluttering the object table
                     if previous_object:
                         previous_object.delete()
-                        model.Session.commit()
+                        self._commit()
                     return False
 
                 # Flag previous object as not current anymore
@@ -337,22 +881,29 @@ class OAIPMHHarvester(HarvesterBase):
                 model.Session.execute('SET CONSTRAINTS harvest_object_package_id_fkey DEFERRED')
                 model.Session.flush()
 
+                if config.get('defer_indexing', False):
+                    indexing.mark_pending(harvest_object)
+
                 log.info('Created new record having package_id %s for guid %s', package_id, harvest_object.guid)
-                model.Session.commit()
+                self._commit()
                 return True
             except p.toolkit.ValidationError, e:
                 self._save_object_error('Validation Error: %s' % str(e.error_summary), harvest_object, 'Import')
                 return False
 
         elif status == 'change':
-            # Set force_harvest_update from config if it exists, default to false
+            # Set force_harvest_update from config if it exists, default to false.
+            # Forced updates are skipped too if the content has not changed,
+            # unless force_harvest_update is 'always'.
             force_harvest_update = config.get('force_harvest_update', False)
 
             if previous_object:
                 # Check if the modified date is more recent
                 is_modified_after_previous = harvest_object.metadata_modified_date > previous_object.metadata_modified_date
 
-                if force_harvest_update or is_modified_after_previous:
+                if (force_harvest_update or is_modified_after_previous) and \
+                        (force_harvest_update == FORCE_UPDATE_ALWAYS or
+                         not self._has_same_content(harvest_object, previous_object)):
                     package_dict['id'] = harvest_object.package_id
                     try:
                         package_id = p.toolkit.get_action('package_update')(context, package_dict)
@@ -371,8 +922,11 @@ class OAIPMHHarvester(HarvesterBase):
                         harvest_object.current = True
                         harvest_object.add()
 
+                        if config.get('defer_indexing', False):
+                            indexing.mark_pending(harvest_object)
+
                         log.info('Updated record having package_id %s for guid %s', package_id, harvest_object.guid)
-                        model.Session.commit()
+                        self._commit()
                         return True
                     except p.toolkit.ValidationError, e:
                         self._save_object_error('Validation Error: %s' % str(e.error_summary), harvest_object, 'Import')
@@ -394,7 +948,7 @@ class OAIPMHHarvester(HarvesterBase):
                     # Delete the previous object to avoid cluttering the object table
                     previous_object.delete()
                     log.info('Document with GUID %s unchanged, skipping...' % harvest_object.guid)
-                    model.Session.commit()
+                    self._commit()
                     return True
             else:
                 self._save_object_error(
@@ -403,3 +957,109 @@ class OAIPMHHarvester(HarvesterBase):
                 return False
 
         return False
+
+    def import_objects(self, harvest_objects, batch_size=None):
+        '''
+        Import several harvest objects, committing them in batches.
+
+        Each object is imported in a savepoint of its own, so that an object
+        whose import fails with an exception rolls back only its own changes.
+        The objects are marked completed or failed like the harvest queue
+        does after import stage.
+        The records stored on the objects of a batch are read together,
+        see :meth:`_prepare_records`.
+
+        :param harvest_objects: iterable of fetched HarvestObject objects
+        :param batch_size: number of objects committed at a time, by default
+                           import_batch_size of the source configuration
+        :returns: number of objects imported successfully
+        '''
+        imported = 0
+        deferred_sources = set()
+        harvest_objects = iter(harvest_objects)
+        self._batch_import = True
+        try:
+            while True:
+                batch = list(itertools.islice(harvest_objects, batch_size or 1))
+                if not batch:
+                    break
+                if batch_size is None:
+                    config = self._get_configuration(batch[0])
+                    batch_size = int(config.get('import_batch_size', DEFAULT_IMPORT_BATCH_SIZE))
+                    batch.extend(itertools.islice(harvest_objects, batch_size - 1))
+                self._prepare_records(batch)
+                for harvest_object in batch:
+                    if self._get_configuration(harvest_object).get('defer_indexing', False):
+                        deferred_sources.add(harvest_object.harvest_source_id)
+                    harvest_object.import_started = datetime.datetime.utcnow()
+                    success = self._import_in_savepoint(harvest_object)
+                    harvest_object.state = u'COMPLETE' if success else u'ERROR'
+                    harvest_object.import_finished = datetime.datetime.utcnow()
+                    harvest_object.add()
+                    if success:
+                        imported += 1
+                self._commit_batch(deferred_sources)
+        finally:
+            self._batch_import = False
+            self._prepared_records = None
+        for source_id in deferred_sources:
+            indexing.reindex_pending(source_id)
+        return imported
+
+    def import_job(self, harvest_job, batch_size=None):
+        ''' Import the objects of a harvest job which have not been imported,
+        committing them in batches with :meth:`import_objects`.
+
+        Used by the ``oaipmh import`` command, e.g. for finishing a job whose
+        objects were left waiting when the harvest queue stopped. The harvest
+        queue must not be processing the job at the same time.
+
+        :param harvest_job: HarvestJob object
+        :param batch_size: number of objects committed at a time
+        :returns: number of objects imported successfully
+        '''
+        object_ids = [object_id for object_id, in model.Session.query(HarvestObject.id)
+                      .filter(HarvestObject.harvest_job_id == harvest_job.id)
+                      .filter(HarvestObject.state.in_(oaipmh_model.UNIMPORTED_STATES))
+                      .order_by(HarvestObject.guid)]
+        log.info('Importing %d harvest objects of job %s', len(object_ids), harvest_job.id)
+        return self.import_objects((HarvestObject.get(object_id) for object_id in object_ids), batch_size)
+
+    def _commit_batch(self, deferred_sources):
+        ''' Commit a batch of imported objects, indexing their packages
+        later if indexing is deferred for any of their sources '''
+        if deferred_sources:
+            with indexing.deferred():
+                model.Session.commit()
+        else:
+            model.Session.commit()
+
+    def _import_in_savepoint(self, harvest_object):
+        ''' Run import stage for one object of a batch in a savepoint '''
+        savepoint = model.Session.begin_nested()
+        try:
+            success = self.import_stage(harvest_object)
+        except Exception as e:
+            log.exception('Import of %s failed', harvest_object.guid)
+            if savepoint.is_active:
+                savepoint.rollback()
+            self._save_object_error('Import: {e}'.format(e=e), harvest_object, 'Import')
+            return False
+        if savepoint.is_active:
+            savepoint.commit()
+        return success
+
+    def _commit(self):
+        ''' Commit the changes of import stage, unless importing a batch '''
+        if self._batch_import:
+            model.Session.flush()
+        else:
+            model.Session.commit()
+
+    def _save_object_error(self, message, obj, stage=u'Fetch', line=None):
+        ''' Save an object error. When importing a batch the error is only
+        added to the session, and committed with the batch. '''
+        if not self._batch_import:
+            return super(OAIPMHHarvester, self)._save_object_error(message, obj, stage, line)
+        model.Session.add(HarvestObjectError(message=message, object=obj, stage=stage, line=line))
+        log.error('{0}, line {1}'.format(message, line) if line else message)
@@ -8,11 +8,13 @@
 # :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
 # :license: GNU Affero General Public License version 3
 
-import cStringIO
+import xml.sax.xmlreader
 
 import oaipmh.common
 import lxml.etree
+import lxml.sax
 import rdflib
+from rdflib.plugins.parsers.rdfxml import RDFXMLHandler
 
 default_namespaces = [('dc', 'http://purl.org/dc/elements/1.1/'),
                       ('dct', 'http://purl.org/dc/terms/'),
@@ -33,6 +35,82 @@ default_namespaces = [('dc', 'http://purl.org/dc/elements/1.1/'),
                       ('prov', 'http://www.w3.org/ns/prov#'), ]
 
 
+# Resolved names kept by each resolver, and resolvers kept for distinct
+# namespace lists, before the caches are emptied
+NAME_CACHE_SIZE = 4096
+RESOLVER_CACHE_SIZE = 256
+
+
+class NamespaceResolver(object):
+    '''Substitutes namespace prefixes in names with their short forms.
+
+    Gives the same results as trying each (short prefix, long prefix)
+    pair in turn, followed by default_namespaces, and using the first
+    long prefix the name starts with, either as such or in the {URI}
+    form used by lxml. The long prefixes are compiled into a dict
+    searched by name prefix length, and resolved names are cached.
+
+    :param namespaces: a list of (short prefix, long prefix) pairs
+    :type namespaces: list of (string, string)
+    '''
+
+    def __init__(self, namespaces):
+        self.prefixes = {}
+        for index, (prefix, nsurl) in enumerate(list(namespaces) + default_namespaces):
+            # rdflib gives URIRefs, which do not compare equal to strings
+            # as dict keys
+            prefix = u'' if prefix is None else unicode(prefix) + u':'
+            nsurl = unicode(nsurl)
+            for long_prefix in (nsurl, u'{%s}' % nsurl):
+                self.prefixes.setdefault(long_prefix, (index, prefix))
+        self.lengths = sorted(set(len(long_prefix) for long_prefix in self.prefixes))
+        self.cache = {}
+
+    def resolve(self, name):
+        '''Return the name with a short prefix, or unchanged if no
+        namespace matches
+
+        :param name: the URL or {URI}name
+        :type name: string
+        :rtype: string
+        '''
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        best = None
+        for length in self.lengths:
+            if length > len(name):
+                break
+            match = self.prefixes.get(name[:length])
+            if match is not None and (best is None or match[0] < best[0]):
+                best = match + (length,)
+        resolved = name if best is None else best[1] + name[best[2]:]
+        if len(self.cache) >= NAME_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[name] = resolved
+        return resolved
+
+
+_resolvers = {}
+
+
+def resolver_for(namespaces):
+    '''Return a shared resolver for a list of namespaces
+
+    :param namespaces: a list of (short prefix, long prefix) pairs
+    :type namespaces: list of (string, string)
+    :rtype: NamespaceResolver
+    '''
+    key = tuple(namespaces)
+    resolver = _resolvers.get(key)
+    if resolver is None:
+        if len(_resolvers) >= RESOLVER_CACHE_SIZE:
+            _resolvers.clear()
+        resolver = _resolvers[key] = NamespaceResolver(key)
+    return resolver
+
+
 def namespaced_name(name, namespaces):
     '''Substitutes a namespace prefix in a URL with its short form.
 
@@ -43,17 +121,7 @@ def namespaced_name(name, namespaces):
     :returns: the URL, with a short prefix
     :rtype: string
     '''
-    for prefix, nsurl in namespaces + default_namespaces:
-        if prefix is None:
-            prefix = ''
-        else:
-            prefix += ':'
-        if name.startswith(nsurl):
-            return prefix + name[len(nsurl):]
-        nsurl = '{%s}' % nsurl
-        if name.startswith(nsurl):
-            return prefix + name[len(nsurl):]
-    return name
+    return resolver_for(namespaces).resolve(name)
 
 
 def namepath_for_element(prefix, name, indices, md):
@@ -87,28 +155,49 @@ def namepath_for_element(prefix, name, indices, md):
 def generic_xml_metadata_reader(xml_element):
     '''Transform XML documents into metadata dictionaries
 
+    The tree is traversed without recursion. Each element resolves its
+    names with the resolver of its parent, and a shared resolver is looked
+    up only for elements which declare namespaces. Comments and
+    processing instructions are skipped.
+
     :param xml_element: XML document
     :type xml_element: lxml.etree.Element
     :returns: metadata dictionary with all the content of xml_element
     :rtype: oaipmh.common.Metadata
     '''
-    def flatten_with(prefix, element, result):
-        '''Recursive traversal of XML tree'''
-        if element.text and element.text.strip():
-            result[prefix] = element.text.strip()
-        for attr in element.attrib:
-            name = namespaced_name(attr, element.nsmap.items())
-            result['%s/@%s' % (prefix, name)] = element.attrib[attr]
-        indices = {}
-        for child in element:
-            name = namespaced_name(child.tag, child.nsmap.items())
-            child_path = namepath_for_element(
-                prefix, name, indices, result)
-            flatten_with(child_path, child, result)
-
     result = {}
-    flatten_with(namespaced_name(xml_element.tag, xml_element.nsmap.items()),
-                 xml_element, result)
+    # (name path, resolver, child indices) of the elements being visited
+    open_elements = []
+    declares_namespaces = False
+    for event, element in lxml.etree.iterwalk(xml_element, events=('start-ns', 'start', 'end')):
+        if event == 'start-ns':
+            # Declarations are reported before the element declaring them
+            declares_namespaces = True
+            continue
+        if not isinstance(element.tag, basestring):
+            continue
+        if event == 'end':
+            open_elements.pop()
+            continue
+        if declares_namespaces or not open_elements:
+            resolver = resolver_for(element.nsmap.items())
+            declares_namespaces = False
+        else:
+            resolver = open_elements[-1][1]
+        name = resolver.resolve(element.tag)
+        if open_elements:
+            parent, _, indices = open_elements[-1]
+            prefix = namepath_for_element(parent, name, indices, result)
+        else:
+            prefix = name
+        text = element.text
+        if text:
+            text = text.strip()
+            if text:
+                result[prefix] = text
+        for attr, value in element.attrib.items():
+            result['%s/@%s' % (prefix, resolver.resolve(attr))] = value
+        open_elements.append((prefix, resolver, {}))
     return oaipmh.common.Metadata(xml_element, result)
 
 
@@ -133,6 +222,34 @@ def is_reverse_relation(rel1, rel2):
     return rel1 == 'rev:' + rel2 or rel2 == 'rev:' + rel1
 
 
+def rdf_graph(xml_element):
+    '''Build an RDF graph from an already parsed RDF/XML document
+
+    The element tree is fed to the RDF/XML handler of rdflib as SAX
+    events, instead of serializing it and parsing the text again.
+    Relative URIs are resolved against an empty base, as when parsing
+    the serialized document.
+
+    :param xml_element: rdf:RDF element
+    :type xml_element: lxml.etree.Element instance
+    :returns: the graph
+    :rtype: rdflib.Graph instance
+    '''
+    graph = rdflib.Graph()
+    source = xml.sax.xmlreader.InputSource()
+    source.setPublicId('')  # could be the metadata source URL
+    handler = RDFXMLHandler(graph)
+    handler.setDocumentLocator(source)
+    lxml.sax.saxify(xml_element, handler)
+    return graph
+
+
+def _arc_key(arc):
+    '''Sort key of a (name, node) arc of an RDF graph'''
+    name, node = arc
+    return name, type(node).__name__, unicode(node)
+
+
 def generic_rdf_metadata_reader(xml_element):
     '''Transform RDF/XML documents into metadata dictionaries
 
@@ -140,52 +257,59 @@ def generic_rdf_metadata_reader(xml_element):
     into an RDF graph, and traverses that graph to find all nodes in
     the graph and give them namepaths.
 
+    The arcs of each node are collected once per graph, and the graph
+    is traversed depth first with an explicit stack. The forward arcs
+    of a node are followed before its reverse arcs, both sorted by name
+    and by the node they lead to, so that the namepaths do not depend
+    on the order of the triples in the graph. Arcs with the same name
+    to different blank nodes are ordered by the generated ids of the
+    blank nodes.
+
     :param xml_element: RDF/XML document
     :type xml_element: lxml.etree.Element instance
     :returns: metadata dictionary
     :rtype: oaipmh.common.Metadata instance
     '''
-    etree = lxml.etree
-    g = rdflib.Graph()
-    e = etree.ElementTree(xml_element[0])
+    g = rdf_graph(xml_element[0])
     ns = dict((prefix, rdflib.Namespace(nsurl)) for prefix, nsurl in default_namespaces)
-    # this is kinda stupid, but by far the easiest way:
-    # rdflib uses xml.sax so it doesn't understand etree,
-    # so text is the only common language spoken by lxml and rdflib
-    f = cStringIO.StringIO(etree.tostring(e, xml_declaration=True, encoding='utf-8'))
-    g.parse(f, format='xml')  # publicID could be the metadata source URL
-    # end stupid
 
-    visited = set()
+    resolver = resolver_for(list(g.namespaces()))
+    names = {}
+    arcs = {}
+    for s, p, o in g:
+        if p not in names:
+            name = resolver.resolve(unicode(p))
+            names[p] = (name, 'rev:' + name)
+        forward, reverse = names[p]
+        arcs.setdefault(s, ([], []))[0].append((forward, o))
+        arcs.setdefault(o, ([], []))[1].append((reverse, s))
 
-    def flatten_with(prefix, node, result):
-        '''Recursive traversal of RDF graph'''
-        path = prefix.split('/')
-        if len(path) > 2 and is_reverse_relation(path[-1], path[-2]):
-            return
+    datasets = list(g.subjects(ns['rdf']['type'], ns['nrd']['Dataset']))
+    assert len(datasets) == 1
+    root_node = datasets[0]
+    result = {}
+    visited = set()
+    # Namepath of a node, the last two names in the path, and the node.
+    # Paths which return over the arc they came from are not followed.
+    stack = [(u'dataset', (None, None), root_node)]
+    while stack:
+        prefix, (parent_name, name), node = stack.pop()
+        if parent_name is not None and is_reverse_relation(name, parent_name):
+            continue
         result[prefix] = unicode(node)
         if node in visited:
-            return
+            continue
         visited.add(node)
         if hasattr(node, 'language') and node.language:
             result[prefix + '/language'] = node.language
+        forward, reverse = arcs.get(node, ([], []))
         indices = {}
-        arcs = [(namespaced_name(str(p), list(g.namespaces())), o)
-                for p, o in g.predicate_objects(node)] + \
-               [('rev:' + namespaced_name(str(p), list(g.namespaces())), s)
-                for s, p in g.subject_predicates(node)]
-
-        for name, child in arcs:
-            child_path = namepath_for_element(prefix, name,
-                                              indices, result)
-            flatten_with(child_path, child, result)
-
-    datasets = list(g.subjects(ns['rdf']['type'], ns['nrd']['Dataset']))
-    assert len(datasets) == 1
-    root_node = datasets[0]
-    result = {}
-    flatten_with(u'dataset', root_node, result)
-    return oaipmh.common.Metadata(result)
+        children = []
+        for arc_name, child in sorted(forward, key=_arc_key) + sorted(reverse, key=_arc_key):
+            child_path = namepath_for_element(prefix, arc_name, indices, result)
+            children.append((child_path, (name, child_path[len(prefix) + 1:]), child))
+        stack.extend(reversed(children))
+    return oaipmh.common.Metadata(xml_element, result)
 
 
 def dummy_metadata_reader(xml_element):
@@ -93,6 +93,132 @@ def person_attrs(source, dest, result):
     copy_element(source + '/foaf:phone', dest + '/phone', result)
 
 
+# Keys copied with every element by copy_element, relative to the element
+_LANGUAGE_VARIANTS = [
+    (u'/language', u'/language'),
+    (u'/@lang', u'/language'),
+    (u'/@xml:lang', u'/language'),
+    (u'/@rdf:resource', u''),  # overwrites any possible element text
+]
+_index_suffixes = []
+
+
+def _index_suffix(i):
+    while len(_index_suffixes) <= i:
+        _index_suffixes.append('.%d' % len(_index_suffixes))
+    return _index_suffixes[i]
+
+
+class CopyPlan(object):
+    '''Precomputed plan of copy_element calls for a mapping table
+
+    The mapping table is a list of (source, dest, callback) tuples, where
+    callback is None or another mapping table, whose keys are relative to
+    the source and dest of the copied element.  The table is compiled
+    once, and applying the plan to a metadata dictionary copies the same
+    keys in the same order as calling copy_element for every row of the
+    table, without recursion.
+
+    :param mapping: mapping table
+    :type mapping: list of (string, string, list or None) tuples
+    '''
+
+    def __init__(self, mapping):
+        variants = [[source, dest, None] for source, dest in _LANGUAGE_VARIANTS]
+        for variant in variants:
+            variant[2] = variants[::-1]
+        self._variants = variants
+        self._steps = self._compile(mapping)
+
+    def _compile(self, mapping):
+        '''Return steps of a mapping table as (source, dest, children)
+        tuples, with the children in the order they are stacked'''
+        steps = []
+        for source, dest, callback in mapping:
+            children = self._variants + (self._compile(callback) if callback else [])
+            steps.append((source, dest, children[::-1]))
+        return steps
+
+    def apply(self, md):
+        '''Copy the elements of the plan in a metadata dictionary
+
+        :param md: a metadata dictionary to update
+        :type md: hash from string to any value (inout)
+        '''
+        stack = [(step, step[0], step[1]) for step in reversed(self._steps)]
+        pop, push = stack.pop, stack.append
+        while stack:
+            step, source, dest = pop()
+            if source in md:
+                md[dest] = md[source]
+                for child in step[2]:
+                    push((child, source + child[0], dest + child[1]))
+                continue
+
+            count = md.get(source + '.count', 0)
+            if not count:
+                continue
+            md[dest + '.count'] = count
+            for i in range(count - 1, -1, -1):
+                suffix = _index_suffix(i)
+                push((step, source + suffix, dest + suffix))
+
+
+PERSON_ATTRS = [
+    (u'/foaf:name', u'/name', None),
+    (u'/foaf:mbox', u'/email', None),
+    (u'/foaf:phone', u'/phone', None),
+]
+
+DOCUMENT_ATTRS = [
+    (u'/dct:title', u'/title', None),
+    (u'/dct:identifier', u'', None),
+    (u'/dct:creator', u'/creator.0/name', None),
+    (u'/nrd:creator', u'/creator', PERSON_ATTRS),
+    (u'/dct:description', u'/description', None),
+]
+
+FUNDING_ATTRS = [
+    (u'/rev:arpfo:funds.0/arpfo:grantNumber', u'/fundingNumber', None),
+    (u'/rev:arpfo:funds.0/rev:arpfo:provides', u'/funder', PERSON_ATTRS),
+]
+
+FILE_ATTRS = [
+    (u'/dcat:mediaType', u'/mimetype', None),
+    (u'/fp:checksum.0/fp:checksumValue.0', u'/checksum.0', None),
+    (u'/fp:checksum.0/fp:generator.0', u'/checksum.0/algorithm', None),
+    (u'/dcat:byteSize', u'/size', None),
+]
+
+NRD_MAPPING = [
+    (u'dataset', u'versionidentifier', None),
+    (u'dataset/nrd:continuityIdentifier', u'continuityidentifier', None),
+    (u'dataset/rev:foaf:primaryTopic.0/nrd:metadataIdentifier', u'metadata/identifier', None),
+    (u'dataset/rev:foaf:primaryTopic.0/nrd:metadataModified', u'metadata/modified', None),
+    (u'dataset/dct:title', u'title', None),
+    (u'dataset/nrd:modified', u'modified', None),
+    (u'dataset/nrd:rights', u'rights', None),
+    (u'dataset/nrd:language', u'language', None),
+    (u'dataset/nrd:owner', u'owner', PERSON_ATTRS),
+    (u'dataset/nrd:creator', u'creator', PERSON_ATTRS),
+    (u'dataset/nrd:distributor', u'distributor', PERSON_ATTRS),
+    (u'dataset/nrd:contributor', u'contributor', PERSON_ATTRS),
+    (u'dataset/nrd:subject', u'subject', None),  # fetch tags?
+    (u'dataset/nrd:producerProject', u'project', FUNDING_ATTRS),
+    (u'dataset/dct:isPartOf', u'collection', DOCUMENT_ATTRS),
+    (u'dataset/dct:requires', u'requires', None),
+    (u'dataset/nrd:discipline', u'discipline', None),
+    (u'dataset/nrd:temporal', u'temporalcoverage', None),
+    (u'dataset/nrd:spatial', u'spatialcoverage', None),  # names?
+    (u'dataset/nrd:manifestation', u'resource', FILE_ATTRS),
+    (u'dataset/nrd:observationMatrix', u'variables', None),  # TODO
+    (u'dataset/nrd:usedByPublication', u'publication', DOCUMENT_ATTRS),
+    (u'dataset/dct:description', u'description', None),
+]
+
+_nrd_plan = CopyPlan(NRD_MAPPING)
+
+
 def nrd_metadata_reader(xml):
         '''Read metadata in NRD schema
 
@@ -106,54 +232,7 @@ def nrd_metadata_reader(xml):
         :rtype: a hash from string to any value
         '''
         result = rdf_reader(xml).getMap()
-
-        def document_attrs(source, dest, result):
-                '''Callback for copying document attributes'''
-                copy_element(source + '/dct:title', dest + '/title', result)
-                copy_element(source + '/dct:identifier', dest, result)
-                copy_element(source + '/dct:creator', dest + '/creator.0/name', result)
-                copy_element(source + '/nrd:creator', dest + '/creator', result, person_attrs)
-                copy_element(source + '/dct:description', dest + '/description', result)
-
-        def funding_attrs(source, dest, result):
-                '''Callback for copying project attributes'''
-                copy_element(source + '/rev:arpfo:funds.0/arpfo:grantNumber', dest + '/fundingNumber', result)
-                copy_element(source + '/rev:arpfo:funds.0/rev:arpfo:provides', dest + '/funder', result, person_attrs)
-
-        def file_attrs(source, dest, result):
-                '''Callback for copying manifestation attributes'''
-                copy_element(source + '/dcat:mediaType', dest + '/mimetype', result)
-                copy_element(source + '/fp:checksum.0/fp:checksumValue.0', dest + '/checksum.0', result)
-                copy_element(source + '/fp:checksum.0/fp:generator.0', dest + '/checksum.0/algorithm', result)
-                copy_element(source + '/dcat:byteSize', dest + '/size', result)
-
-        mapping = [
-            (u'dataset', u'versionidentifier', None),
-            (u'dataset/nrd:continuityIdentifier', u'continuityidentifier', None),
-            (u'dataset/rev:foaf:primaryTopic.0/nrd:metadataIdentifier', u'metadata/identifier', None),
-            (u'dataset/rev:foaf:primaryTopic.0/nrd:metadataModified', u'metadata/modified', None),
-            (u'dataset/dct:title', u'title', None),
-            (u'dataset/nrd:modified', u'modified', None),
-            (u'dataset/nrd:rights', u'rights', None),
-            (u'dataset/nrd:language', u'language', None),
-            (u'dataset/nrd:owner', u'owner', person_attrs),
-            (u'dataset/nrd:creator', u'creator', person_attrs),
-            (u'dataset/nrd:distributor', u'distributor', person_attrs),
-            (u'dataset/nrd:contributor', u'contributor', person_attrs),
-            (u'dataset/nrd:subject', u'subject', None),  # fetch tags?
-            (u'dataset/nrd:producerProject', u'project', funding_attrs),
-            (u'dataset/dct:isPartOf', u'collection', document_attrs),
-            (u'dataset/dct:requires', u'requires', None),
-            (u'dataset/nrd:discipline', u'discipline', None),
-            (u'dataset/nrd:temporal', u'temporalcoverage', None),
-            (u'dataset/nrd:spatial', u'spatialcoverage', None),  # names?
-            (u'dataset/nrd:manifestation', u'resource', file_attrs),
-            (u'dataset/nrd:observationMatrix', u'variables', None),  # TODO
-            (u'dataset/nrd:usedByPublication', u'publication', document_attrs),
-            (u'dataset/dct:description', u'description', None),
-        ]
-        for source, dest, callback in mapping:
-                copy_element(source, dest, result, callback)
+        _nrd_plan.apply(result)
         try:
                 rights = lxml.etree.XML(result[u'rights'])
                 rightsclass = rights.attrib['RIGHTSCATEGORY'].lower()
@@ -164,7 +243,28 @@ def nrd_metadata_reader(xml):
                         result[u'accessURL'] = rights[0].text
         except:
             pass
-        return oc.Metadata(result)
+        return oc.Metadata(xml, result)
+
+
+class BatchMetadataRegistry(om.MetadataRegistry):
+    '''Metadata registry which can also read many elements at once
+
+    Readers with a read_many method read all elements in one call, others
+    are called once per element.
+    '''
+
+    def readMetadataBatch(self, metadata_prefix, elements):
+        '''Turn XML elements into metadata objects
+
+        :param metadata_prefix: metadata format of the elements
+        :param elements: list of elements to read
+        :returns: list of metadata objects, in the order of elements
+        '''
+        reader = self._readers[metadata_prefix]
+        read_many = getattr(reader, 'read_many', None)
+        if read_many is None:
+            return [reader(element) for element in elements]
+        return read_many(elements)
 
 
 def create_metadata_registry(harvest_type=None, service_url=None):
@@ -174,9 +274,9 @@ def create_metadata_registry(harvest_type=None, service_url=None):
     oai_dc, nrd, rdf and xml.
 
     :returns: metadata registry instance
-    :rtype: oaipmh.metadata.MetadataRegistry
+    :rtype: BatchMetadataRegistry
     '''
-    registry = om.MetadataRegistry()
+    registry = BatchMetadataRegistry()
     # registry.registerReader('oai_dc', dc_metadata_reader(harvest_type or 'default'))
     registry.registerReader('cmdi0571', CmdiReader(service_url))
     registry.registerReader('oai_datacite', DataCiteReader())
@@ -0,0 +1,144 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import datetime
+import logging
+
+from ckanext.oaipmh import model as oaipmh_model
+from ckanext.oaipmh.model import OAIPMHHarvestState
+
+log = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def parse_date(value):
+    ''' Parse a YYYY-MM-DD date from harvest source configuration '''
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, DATE_FORMAT)
+
+
+class HarvestWindow(object):
+    ''' Datestamp window of one harvest job.
+
+    Gives the 'from' and 'until' arguments for listing each set, and keeps
+    track of the newest header datestamp seen in each set. With incremental
+    harvesting enabled the newest datestamps are stored as high-water marks
+    and used as 'from' of the next harvest of the same source and set.
+    The marks are pending until the objects of the harvest job have been
+    imported, see :func:`promote_high_water_marks`.
+
+    Configuration options used:
+
+    - from, until: fixed dates (YYYY-MM-DD) limiting the harvest
+    - incremental: harvest only records changed since the previous harvest
+    - full_resync: ignore the stored high-water marks and list everything
+    '''
+
+    def __init__(self, harvest_source_id, config):
+        self.harvest_source_id = harvest_source_id
+        self.from_date = parse_date(config.get('from'))
+        self.until_date = parse_date(config.get('until'))
+        self.incremental = bool(config.get('incremental', False))
+        self.full_resync = bool(config.get('full_resync', False))
+        self.newest = {}
+
+    def is_restricted(self):
+        ''' Whether listing requests use any datestamp arguments '''
+        return bool(self.from_date or self.until_date or (self.incremental and not self.full_resync))
+
+    def configure_client(self, client):
+        ''' Adapt the datestamp granularity of client to the repository.
+
+        Repositories must support day granularity, so it is used if the
+        repository does not tell a usable granularity in Identify.
+        '''
+        if not self.is_restricted():
+            return
+        try:
+            client.updateGranularity()
+        except Exception as e:
+            log.warning('Unable to get granularity from repository, using days: %s', e)
+            client._day_granularity = True
+
+    def high_water_mark(self, set_id):
+        ''' Return the stored high-water mark of a set, or None '''
+        if not self.incremental or self.full_resync:
+            return None
+        state = OAIPMHHarvestState.get_for(self.harvest_source_id, set_id)
+        return state.last_datestamp if state else None
+
+    def list_kwargs(self, set_id):
+        ''' Return datestamp arguments for listing the given set '''
+        kwargs = {}
+        from_dates = [d for d in (self.from_date, self.high_water_mark(set_id)) if d]
+        if from_dates:
+            kwargs['from_'] = max(from_dates)
+        if self.until_date:
+            kwargs['until'] = self.until_date
+        return kwargs
+
+    def observe(self, set_id, datestamp):
+        ''' Record a header datestamp seen while listing the given set '''
+        if datestamp and (set_id not in self.newest or datestamp > self.newest[set_id]):
+            self.newest[set_id] = datestamp
+
+    def save(self, harvest_job_id):
+        ''' Store the newest datestamps seen as pending high-water marks of
+        the harvest job.
+
+        The caller is responsible for committing the session.
+        '''
+        if not self.incremental:
+            return
+        for set_id, datestamp in self.newest.items():
+            state = OAIPMHHarvestState.get_or_create(self.harvest_source_id, set_id)
+            if state.last_datestamp is None or datestamp > state.last_datestamp or self.full_resync:
+                state.pending_datestamp = datestamp
+                state.pending_job_id = harvest_job_id
+                state.add()
+
+
+def promote_high_water_marks(harvest_source_id, harvest_object=None, success=True):
+    ''' Make the pending high-water marks of finished harvest jobs the
+    marks used by the next harvest.
+
+    A job has finished when none of its objects wait for fetch or import.
+    Its marks are lowered to the oldest datestamp of its failed objects,
+    so that the next harvest lists the failed records again, as 'from' is
+    inclusive. Objects do not tell their set, so a failure lowers the
+    marks of all sets of the job.
+
+    The caller is responsible for committing the session.
+
+    :param harvest_source_id: id of the harvest source
+    :param harvest_object: HarvestObject just imported, whose state has not
+                           been updated yet. Only its job is checked.
+    :param success: whether harvest_object was imported successfully
+    '''
+    job_id = harvest_object.harvest_job_id if harvest_object is not None else None
+    object_id = harvest_object.id if harvest_object is not None else None
+    # Job id -> (whether the job has finished, oldest failed datestamp)
+    jobs = {}
+    for state in OAIPMHHarvestState.pending_for(harvest_source_id, job_id).all():
+        if state.pending_job_id not in jobs:
+            if oaipmh_model.has_unimported_objects(state.pending_job_id, object_id):
+                jobs[state.pending_job_id] = (False, None)
+            else:
+                failed = [oaipmh_model.oldest_failed_datestamp(state.pending_job_id)]
+                if not success:
+                    failed.append(harvest_object.metadata_modified_date)
+                jobs[state.pending_job_id] = (True, min([d for d in failed if d] or [None]))
+        finished, oldest_failed = jobs[state.pending_job_id]
+        if not finished:
+            continue
+        state.last_datestamp = min(state.pending_datestamp, oldest_failed or state.pending_datestamp)
+        state.pending_datestamp = None
+        state.pending_job_id = None
+        state.add()
+        log.debug('Promoted high-water mark of set %s to %s', state.set_spec, state.last_datestamp)
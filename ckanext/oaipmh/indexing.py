@@ -0,0 +1,117 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import contextlib
+import logging
+import threading
+
+from pylons import config
+
+from ckan import model
+import ckan.lib.search as search
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+
+log = logging.getLogger(__name__)
+
+AUTOMATIC_INDEXING = 'ckan.search.automatic_indexing'
+# Extra of the harvest objects whose packages have not been indexed yet
+PENDING_KEY = 'index_pending'
+DEFAULT_BATCH_SIZE = 1000
+
+_lock = threading.Lock()
+# Number of packages whose indexing has been deferred in this process,
+# by harvest source
+_deferred_counts = {}
+
+
+@contextlib.contextmanager
+def deferred():
+    ''' Do not index the packages changed in this block.
+
+    Indexing is turned off for the whole process while the block runs.
+    '''
+    previous = config.get(AUTOMATIC_INDEXING)
+    config[AUTOMATIC_INDEXING] = False
+    try:
+        yield
+    finally:
+        if previous is None:
+            config.pop(AUTOMATIC_INDEXING, None)
+        else:
+            config[AUTOMATIC_INDEXING] = previous
+
+
+def mark_pending(harvest_object):
+    ''' Remember that the package of a harvest object is to be indexed.
+
+    The mark is stored with the object, so it is committed together with
+    the package and survives until the package is indexed.
+    '''
+    harvest_object.extras.append(HarvestObjectExtra(key=PENDING_KEY, value=u'true'))
+
+
+def job_has_unimported_objects(harvest_job_id):
+    ''' Whether objects of a harvest job are still waiting for fetch or import '''
+    return model.Session.query(HarvestObject.id) \
+        .filter(HarvestObject.harvest_job_id == harvest_job_id) \
+        .filter(HarvestObject.state.in_([u'WAITING', u'FETCH'])) \
+        .first() is not None
+
+
+def reindex_if_due(harvest_object, batch_size=DEFAULT_BATCH_SIZE):
+    ''' Index the pending packages of a source if there are enough of them,
+    or if the harvest job of the object has been imported.
+
+    :param harvest_object: HarvestObject which was just imported, successfully or not
+    :param batch_size: number of packages indexed at a time
+    '''
+    source_id = harvest_object.harvest_source_id
+    with _lock:
+        _deferred_counts[source_id] = _deferred_counts.get(source_id, 0) + 1
+        due = _deferred_counts[source_id] >= batch_size
+    if due or not job_has_unimported_objects(harvest_object.harvest_job_id):
+        reindex_pending(source_id)
+
+
+def reindex_pending(harvest_source_id):
+    ''' Index the packages of all harvest objects of a source marked pending.
+
+    Indexing errors of single packages are logged, and the marks are
+    removed anyway, so that one broken package does not block the others.
+
+    :param harvest_source_id: id of the harvest source
+    :returns: number of indexed packages
+    :rtype: int
+    '''
+    with _lock:
+        _deferred_counts.pop(harvest_source_id, None)
+    pending = model.Session.query(HarvestObjectExtra.id, HarvestObject.package_id) \
+        .join(HarvestObject, HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+        .filter(HarvestObject.harvest_source_id == harvest_source_id) \
+        .filter(HarvestObjectExtra.key == PENDING_KEY) \
+        .all()
+    if not pending:
+        return 0
+
+    package_ids = sorted(set(package_id for _, package_id in pending if package_id))
+    log.info('Indexing %d packages harvested with indexing deferred', len(package_ids))
+    indexed = 0
+    for package_id in package_ids:
+        try:
+            search.rebuild(package_id, defer_commit=True)
+            indexed += 1
+        except Exception as e:
+            log.error('Unable to index package %s: %s', package_id, e)
+    search.commit()
+
+    extra_ids = [extra_id for extra_id, _ in pending]
+    for start in range(0, len(extra_ids), DEFAULT_BATCH_SIZE):
+        model.Session.query(HarvestObjectExtra) \
+            .filter(HarvestObjectExtra.id.in_(extra_ids[start:start + DEFAULT_BATCH_SIZE])) \
+            .delete(synchronize_session=False)
+    model.Session.commit()
+    return indexed
@@ -38,3 +38,27 @@ class IOAIPMHHarvester(Interface):
         :rtype: dict
         '''
         return {}
+
+    def get_oaipmh_package_dicts(self, format, etree_xmls):
+        '''
+        Optional batch version of ``get_oaipmh_package_dict``
+
+        Maps many records of the same format in one call, so that a plugin
+        can share its setup, like vocabularies or compiled XPath
+        expressions, between them. Plugins which do not have this method
+        are called with ``get_oaipmh_package_dict`` once per record.
+
+        Only the ``oaipmh import`` command, which imports harvest objects
+        in batches with ``OAIPMHHarvester.import_objects``, passes many
+        records at a time. Everywhere else this method gets a list of one
+        record: the harvest queue imports one object at a time, and the
+        records of a ListRecords page are not mapped together in gather or
+        fetch stage either.
+
+        :param format: Format of oaipmh harvester source (e.g. cmdi)
+        :param etree_xmls: List of source xml data in etree.
+
+        :returns: A list of dataset dicts, in the order of ``etree_xmls``
+        :rtype: list
+        '''
+        return [self.get_oaipmh_package_dict(format, etree_xml) for etree_xml in etree_xmls]
@@ -0,0 +1,162 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import logging
+import Queue
+import threading
+
+import oaipmh.error
+from oaipmh.datestamp import datetime_to_datestamp
+
+log = logging.getLogger(__name__)
+
+LIST_IDENTIFIERS = 'ListIdentifiers'
+LIST_RECORDS = 'ListRecords'
+
+# Pages listed ahead of the consumer per worker
+QUEUE_SIZE_FACTOR = 2
+PUT_TIMEOUT = 1
+
+
+def list_pages(client, verb, kwargs, resumption_token=None):
+    ''' List one response page at a time.
+
+    :param client: oaipmh.client.Client
+    :param verb: LIST_IDENTIFIERS or LIST_RECORDS
+    :param kwargs: arguments of the first request: metadataPrefix, and
+                   optionally set, from_ and until
+    :param resumption_token: continue an earlier listing from this token
+                             instead of making the first request
+    :returns: generator of (items, resumption token) pairs, where items are
+              headers for ListIdentifiers and (header, metadata, about)
+              tuples for ListRecords, and the token is None on the last page
+    '''
+    namespaces = client.getNamespaces()
+
+    def build(tree):
+        if verb == LIST_RECORDS:
+            return client.buildRecords(kwargs['metadataPrefix'], namespaces, client.getMetadataRegistry(), tree)
+        return client.buildIdentifiers(namespaces, tree)
+
+    if resumption_token is None:
+        args = dict(kwargs)
+        for name, arg in (('from_', 'from'), ('until', 'until')):
+            value = args.pop(name, None)
+            if value is not None:
+                args[arg] = datetime_to_datestamp(value, client._day_granularity)
+        tree = client.makeRequestErrorHandling(verb=verb, **args)
+    else:
+        tree = client.makeRequestErrorHandling(verb=verb, resumptionToken=resumption_token)
+
+    while True:
+        items, token = build(tree)
+        yield items, token
+        if token is None:
+            break
+        tree = client.makeRequestErrorHandling(verb=verb, resumptionToken=token)
+
+
+class SetTask(object):
+    ''' Listing of one set, or of the whole repository if set_id is None '''
+
+    def __init__(self, set_id, kwargs, resumption_token=None):
+        self.set_id = set_id
+        self.kwargs = kwargs
+        self.resumption_token = resumption_token
+
+
+# Events yielded by gather_pages
+PAGE = 'page'
+RESTART = 'restart'
+
+
+def _list_task(client, verb, task):
+    ''' Yield events of listing one set '''
+    try:
+        if task.resumption_token is not None:
+            try:
+                for items, token in list_pages(client, verb, task.kwargs, task.resumption_token):
+                    yield PAGE, items, token
+                return
+            except oaipmh.error.BadResumptionTokenError as e:
+                log.warning('Unable to resume listing set %s, listing it again: %s', task.set_id, e)
+                yield RESTART, None, None
+        for items, token in list_pages(client, verb, task.kwargs):
+            yield PAGE, items, token
+    except oaipmh.error.NoRecordsMatchError:
+        yield PAGE, [], None
+
+
+def gather_pages(client, verb, tasks, workers=1):
+    ''' List several sets, concurrently if workers is more than one.
+
+    The pages are yielded in the calling thread as they are received, so
+    the caller can store them as it likes. With several workers the pages
+    of different sets are interleaved.
+
+    :param client: oaipmh.client.Client
+    :param verb: LIST_IDENTIFIERS or LIST_RECORDS
+    :param tasks: list of SetTask objects
+    :param workers: maximum number of sets listed at a time
+    :returns: generator of (set_id, event, items, resumption token) tuples,
+              where event is PAGE, or RESTART when a listing could not be
+              resumed and is started again, discarding its earlier pages
+    '''
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            for event, items, token in _list_task(client, verb, task):
+                yield task.set_id, event, items, token
+        return
+
+    results = Queue.Queue(maxsize=workers * QUEUE_SIZE_FACTOR)
+    todo = Queue.Queue()
+    stop = threading.Event()
+    for task in tasks:
+        todo.put(task)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def work():
+        while not stop.is_set():
+            try:
+                task = todo.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                for event, items, token in _list_task(client, verb, task):
+                    if not put((task.set_id, event, items, token, None)):
+                        return
+            except Exception as e:
+                put((task.set_id, None, None, None, e))
+                return
+        put(None)
+
+    threads = [threading.Thread(target=work, name='oaipmh-list-%d' % i) for i in range(min(workers, len(tasks)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            item = results.get()
+            if item is None:
+                running -= 1
+                continue
+            set_id, event, items, token, error = item
+            if error is not None:
+                raise error
+            yield set_id, event, items, token
+    finally:
+        stop.set()
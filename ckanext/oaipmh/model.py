@@ -0,0 +1,461 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import cStringIO
+import datetime
+import logging
+
+from sqlalchemy import Table, Column, ForeignKey, Index, types, select, and_, exists, func, nullslast
+from sqlalchemy.engine.reflection import Inspector
+
+from ckan import model
+from ckan.model.meta import metadata, mapper, Session
+from ckan.model.types import make_uuid
+from ckan.model.domain_object import DomainObject
+import ckanext.harvest.model as harvest_model
+
+log = logging.getLogger(__name__)
+
+__all__ = ['OAIPMHHarvestState', 'OAIPMHGatherRecord', 'harvest_state_table', 'gather_record_table',
+           'setup', 'bulk_create_harvest_objects', 'prune_harvest_objects', 'has_staged_records',
+           'staged_records', 'staged_deleted_objects', 'missing_objects', 'has_unimported_objects',
+           'oldest_failed_datestamp', 'binary_ordered', 'create_harvest_object_index']
+
+DEFAULT_CHUNK_SIZE = 1000
+# States of harvest objects which have not been imported
+UNIMPORTED_STATES = (u'WAITING', u'FETCH', u'IMPORT')
+HARVEST_OBJECT_INDEX = 'idx_harvest_object_source_guid_current'
+
+harvest_state_table = None
+gather_record_table = None
+
+
+def setup():
+    ''' Define the OAI-PMH harvester tables and create them if needed. '''
+    if harvest_state_table is None:
+        define_oaipmh_tables()
+        log.debug('OAI-PMH harvester tables defined in memory')
+
+    if not model.package_table.exists():
+        log.debug('OAI-PMH harvester table creation deferred')
+        return
+
+    if not harvest_state_table.exists():
+        harvest_state_table.create()
+        log.debug('OAI-PMH harvester tables created')
+    else:
+        migrate_harvest_state_table()
+
+    if not gather_record_table.exists():
+        gather_record_table.create()
+    else:
+        create_missing_indexes(gather_record_table)
+
+
+def migrate_harvest_state_table():
+    ''' Add the columns missing from an existing harvest state table '''
+    inspector = Inspector.from_engine(model.meta.engine)
+    existing = set(column['name'] for column in inspector.get_columns(harvest_state_table.name))
+    for column in harvest_state_table.columns:
+        if column.name not in existing:
+            log.debug('Adding column %s to %s', column.name, harvest_state_table.name)
+            Session.execute('ALTER TABLE {table} ADD COLUMN {column} {type}'.format(
+                table=harvest_state_table.name, column=column.name,
+                type=column.type.compile(dialect=model.meta.engine.dialect)))
+    Session.commit()
+
+
+def create_missing_indexes(table):
+    ''' Create the indexes of an existing table which are missing from it '''
+    inspector = Inspector.from_engine(model.meta.engine)
+    existing = set(index['name'] for index in inspector.get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in existing:
+            log.debug('Creating index %s', index.name)
+            index.create(model.meta.engine)
+
+
+def create_harvest_object_index():
+    ''' Index the current harvest objects of a source by identifier.
+
+    Gather and import stages look up the current harvest object of a
+    record by source, identifier and the current flag. The index is
+    created with the ``oaipmh create-index`` command, not when CKAN starts,
+    because building it on a large harvest object table takes long. On
+    PostgreSQL it is built concurrently, so that harvesting can go on
+    meanwhile.
+
+    :returns: whether the index was created
+    :rtype: bool
+    '''
+    table = harvest_model.harvest_object_table
+    if table is None or not table.exists():
+        return False
+    inspector = Inspector.from_engine(model.meta.engine)
+    if HARVEST_OBJECT_INDEX in set(index['name'] for index in inspector.get_indexes(table.name)):
+        return False
+    log.debug('Creating index %s', HARVEST_OBJECT_INDEX)
+    if model.meta.engine.dialect.name != 'postgresql':
+        Index(HARVEST_OBJECT_INDEX, table.c.harvest_source_id, table.c.guid, table.c.current) \
+            .create(model.meta.engine)
+        return True
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    connection = model.meta.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        connection.execute('CREATE INDEX CONCURRENTLY {index} ON {table} (harvest_source_id, guid, current)'.format(
+            index=HARVEST_OBJECT_INDEX, table=table.name))
+    finally:
+        connection.close()
+    return True
+
+
+class OAIPMHHarvestState(DomainObject):
+    ''' Harvesting state of one set of a harvest source.
+
+    The set specification is an empty string when the whole repository is
+    harvested without sets.
+    '''
+
+    @classmethod
+    def get_for(cls, harvest_source_id, set_spec):
+        return Session.query(cls) \
+            .filter(cls.harvest_source_id == harvest_source_id) \
+            .filter(cls.set_spec == (set_spec or u'')) \
+            .first()
+
+    @classmethod
+    def get_or_create(cls, harvest_source_id, set_spec):
+        state = cls.get_for(harvest_source_id, set_spec)
+        if state is None:
+            state = cls(harvest_source_id=harvest_source_id, set_spec=set_spec or u'', listing_done=False)
+        return state
+
+    @classmethod
+    def pending_for(cls, harvest_source_id, harvest_job_id=None):
+        ''' Query the states of a source with pending high-water marks,
+        optionally only those of one harvest job '''
+        query = Session.query(cls) \
+            .filter(cls.harvest_source_id == harvest_source_id) \
+            .filter(cls.pending_job_id != None)
+        if harvest_job_id is not None:
+            query = query.filter(cls.pending_job_id == harvest_job_id)
+        return query
+
+    @classmethod
+    def reset_checkpoints(cls, harvest_source_id):
+        ''' Forget the gather checkpoints of all sets of a source '''
+        Session.query(cls) \
+            .filter(cls.harvest_source_id == harvest_source_id) \
+            .update({'resumption_token': None, 'listing_done': False}, synchronize_session=False)
+
+
+class OAIPMHGatherRecord(DomainObject):
+    ''' A record listed by an unfinished gather.
+
+    Listed records are stored here page by page together with the
+    resumption token of their set, so that an interrupted gather can
+    continue the listing instead of starting it again.
+    '''
+
+    @classmethod
+    def for_set(cls, harvest_source_id, set_spec):
+        return Session.query(cls) \
+            .filter(cls.harvest_source_id == harvest_source_id) \
+            .filter(cls.set_spec == (set_spec or u''))
+
+    @classmethod
+    def newest_datestamps(cls, harvest_source_id):
+        ''' Return (set_spec, newest datestamp) pairs of the stored records '''
+        return Session.query(cls.set_spec, func.max(cls.datestamp)) \
+            .filter(cls.harvest_source_id == harvest_source_id) \
+            .group_by(cls.set_spec) \
+            .all()
+
+    @classmethod
+    def clear(cls, harvest_source_id, set_spec=None):
+        ''' Remove the stored records of a set, or of all sets if set_spec is None '''
+        query = Session.query(cls).filter(cls.harvest_source_id == harvest_source_id)
+        if set_spec is not None:
+            query = query.filter(cls.set_spec == set_spec)
+        query.delete(synchronize_session=False)
+
+
+def define_oaipmh_tables():
+    global harvest_state_table
+    global gather_record_table
+
+    harvest_state_table = Table(
+        'oaipmh_harvest_state', metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('harvest_source_id', types.UnicodeText, ForeignKey('harvest_source.id'), nullable=False),
+        Column('set_spec', types.UnicodeText, nullable=False, default=u''),
+        # Newest header datestamp seen in the set, used as 'from' argument
+        # of the next incremental harvest
+        Column('last_datestamp', types.DateTime, nullable=True),
+        Column('modified', types.DateTime, default=datetime.datetime.utcnow,
+               onupdate=datetime.datetime.utcnow),
+        # Checkpoint of an unfinished gather: resumption token of the next
+        # page, and whether the set has been listed completely
+        Column('resumption_token', types.UnicodeText, nullable=True),
+        Column('listing_done', types.Boolean, nullable=True, default=False),
+        # Newest header datestamp listed by a harvest job whose objects have
+        # not all been imported yet, and the job. The datestamp becomes
+        # last_datestamp when the job has finished.
+        Column('pending_datestamp', types.DateTime, nullable=True),
+        Column('pending_job_id', types.UnicodeText, nullable=True),
+    )
+
+    gather_record_table = Table(
+        'oaipmh_gather_record', metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('harvest_source_id', types.UnicodeText, ForeignKey('harvest_source.id'), nullable=False),
+        Column('set_spec', types.UnicodeText, nullable=False, default=u''),
+        Column('identifier', types.UnicodeText, nullable=False),
+        Column('datestamp', types.DateTime, nullable=True),
+        Column('deleted', types.Boolean, nullable=False, default=False),
+        Column('content', types.UnicodeText, nullable=True),
+        Index('idx_oaipmh_gather_record_source_set', 'harvest_source_id', 'set_spec'),
+        Index('idx_oaipmh_gather_record_source_identifier', 'harvest_source_id', 'identifier'),
+    )
+
+    mapper(OAIPMHHarvestState, harvest_state_table)
+    mapper(OAIPMHGatherRecord, gather_record_table)
+
+
+def binary_ordered(column):
+    ''' Compare and sort a text column by code points, like Python.
+
+    PostgreSQL compares text in the collation of the database, which
+    usually differs from code point order, so the "C" collation is used.
+    sqlite compares text as binary, which is code point order already.
+    '''
+    if Session.bind.dialect.name == 'postgresql':
+        return column.collate('C')
+    return column
+
+
+def bulk_create_harvest_objects(harvest_job, objects, chunk_size=DEFAULT_CHUNK_SIZE, use_copy=False):
+    ''' Insert harvest objects and their extras without the ORM.
+
+    The objects are written in chunks in the current transaction, which the
+    caller is responsible for committing. With use_copy the rows are
+    written with PostgreSQL COPY, if the database is PostgreSQL.
+
+    :param harvest_job: HarvestJob the objects belong to
+    :param objects: iterable of dicts with keys guid and optionally content,
+                    package_id, metadata_modified_date, state, report_status
+                    and extras, a dict from extra key to value
+    :param chunk_size: number of objects written at a time
+    :param use_copy: whether to use COPY instead of INSERT
+    :returns: list of ids of the created objects, in the order given
+    :rtype: list of strings
+    '''
+    if use_copy and Session.bind.dialect.name != 'postgresql':
+        log.debug('COPY is only supported with PostgreSQL, using INSERT')
+        use_copy = False
+    write = _copy_rows if use_copy else _insert_rows
+
+    object_ids = []
+    object_rows = []
+    extra_rows = []
+    gathered = datetime.datetime.utcnow()
+    for obj in objects:
+        object_id = make_uuid()
+        object_ids.append(object_id)
+        object_rows.append({
+            'id': object_id,
+            'guid': obj['guid'],
+            'current': False,
+            'gathered': gathered,
+            'content': obj.get('content'),
+            'state': obj.get('state', u'WAITING'),
+            'metadata_modified_date': obj.get('metadata_modified_date'),
+            'retry_times': 0,
+            'harvest_job_id': harvest_job.id,
+            'harvest_source_id': harvest_job.source.id,
+            'package_id': obj.get('package_id'),
+            'report_status': obj.get('report_status'),
+        })
+        for key, value in (obj.get('extras') or {}).items():
+            extra_rows.append({
+                'id': make_uuid(),
+                'harvest_object_id': object_id,
+                'key': key,
+                'value': value,
+            })
+        if len(object_rows) >= chunk_size:
+            write(harvest_model.harvest_object_table, object_rows)
+            write(harvest_model.harvest_object_extra_table, extra_rows)
+            object_rows, extra_rows = [], []
+    if object_rows:
+        write(harvest_model.harvest_object_table, object_rows)
+        write(harvest_model.harvest_object_extra_table, extra_rows)
+    return object_ids
+
+
+def _insert_rows(table, rows):
+    if rows:
+        Session.execute(table.insert(), rows)
+
+
+def _copy_value(value):
+    ''' Format a value for the text format of PostgreSQL COPY '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_rows(table, rows):
+    if not rows:
+        return
+    columns = rows[0].keys()
+    data = cStringIO.StringIO()
+    for row in rows:
+        data.write('\t'.join(_copy_value(row[column]) for column in columns))
+        data.write('\n')
+    data.seek(0)
+    cursor = Session.connection().connection.cursor()
+    cursor.copy_expert('COPY {table} ({columns}) FROM STDIN'.format(
+        table=table.name, columns=', '.join('"%s"' % column for column in columns)), data)
+
+
+def prune_harvest_objects(harvest_source_id, older_than, chunk_size=DEFAULT_CHUNK_SIZE):
+    ''' Delete finished harvest objects of a source which are no longer current.
+
+    The objects are deleted together with their extras and errors in chunks
+    in the current transaction, which the caller is responsible for
+    committing. Current objects and objects of unfinished jobs are kept.
+
+    :param harvest_source_id: id of the harvest source
+    :param older_than: delete objects gathered before this datetime
+    :param chunk_size: number of objects deleted at a time
+    :returns: number of deleted objects
+    :rtype: int
+    '''
+    objects = harvest_model.harvest_object_table
+    query = select([objects.c.id]).where(and_(
+        objects.c.harvest_source_id == harvest_source_id,
+        objects.c.current == False,
+        objects.c.state.in_([u'COMPLETE', u'ERROR']),
+        objects.c.gathered < older_than)).limit(chunk_size)
+
+    deleted = 0
+    while True:
+        object_ids = [row[0] for row in Session.execute(query)]
+        if not object_ids:
+            return deleted
+        for table in (harvest_model.harvest_object_extra_table, harvest_model.harvest_object_error_table):
+            Session.execute(table.delete().where(table.c.harvest_object_id.in_(object_ids)))
+        Session.execute(objects.delete().where(objects.c.id.in_(object_ids)))
+        deleted += len(object_ids)
+
+
+def has_staged_records(harvest_source_id, set_specs):
+    ''' Whether any records of the given sets are in the staging table '''
+    return Session.query(OAIPMHGatherRecord.id) \
+        .filter(OAIPMHGatherRecord.harvest_source_id == harvest_source_id) \
+        .filter(OAIPMHGatherRecord.set_spec.in_(set_specs)) \
+        .first() is not None
+
+
+def staged_records(harvest_source_id, set_specs, chunk_size=DEFAULT_CHUNK_SIZE):
+    ''' Stream the staged records of a source joined with their current
+    harvest objects.
+
+    The rows are read from a server side cursor chunk_size at a time. Each
+    identifier is given once, in code point order of identifiers like the
+    order the in-memory gather creates objects in. An identifier
+    listed in several sets is deleted if it is marked deleted in any of
+    them, and otherwise has its newest datestamp.
+
+    :param harvest_source_id: id of the harvest source
+    :param set_specs: set specifications of the listed sets, u'' for the
+                      whole repository
+    :param chunk_size: number of rows fetched at a time
+    :returns: generator of (identifier, datestamp, deleted, content,
+              object id, package id, metadata_modified_date) tuples, where
+              the last three are None for records without a current object
+    '''
+    staged = gather_record_table
+    objects = harvest_model.harvest_object_table
+    query = select([staged.c.identifier, staged.c.datestamp, staged.c.deleted, staged.c.content,
+                    objects.c.id, objects.c.package_id, objects.c.metadata_modified_date]) \
+        .select_from(staged.outerjoin(objects, and_(objects.c.guid == staged.c.identifier,
+                                                    objects.c.current == True,
+                                                    objects.c.harvest_source_id == harvest_source_id))) \
+        .where(and_(staged.c.harvest_source_id == harvest_source_id, staged.c.set_spec.in_(set_specs))) \
+        .order_by(binary_ordered(staged.c.identifier), staged.c.deleted.desc(),
+                  nullslast(staged.c.datestamp.desc()))
+
+    result = Session.connection().execution_options(stream_results=True).execute(query)
+    previous = None
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                if row[0] != previous:
+                    previous = row[0]
+                    yield tuple(row)
+    finally:
+        result.close()
+
+
+def staged_deleted_objects(harvest_source_id, set_specs):
+    ''' Query (identifier, package id) of current harvest objects whose
+    records are marked deleted in the staging table '''
+    HarvestObject = harvest_model.HarvestObject
+    return Session.query(HarvestObject.guid, HarvestObject.package_id) \
+        .filter(HarvestObject.harvest_source_id == harvest_source_id) \
+        .filter(HarvestObject.current == True) \
+        .filter(exists().where(and_(OAIPMHGatherRecord.identifier == HarvestObject.guid,
+                                    OAIPMHGatherRecord.harvest_source_id == harvest_source_id,
+                                    OAIPMHGatherRecord.set_spec.in_(set_specs),
+                                    OAIPMHGatherRecord.deleted == True)))
+
+
+def missing_objects(harvest_source_id, set_specs):
+    ''' Query (identifier, package id) of current harvest objects whose
+    records are not in the staging table '''
+    HarvestObject = harvest_model.HarvestObject
+    return Session.query(HarvestObject.guid, HarvestObject.package_id) \
+        .filter(HarvestObject.harvest_source_id == harvest_source_id) \
+        .filter(HarvestObject.current == True) \
+        .filter(~exists().where(and_(OAIPMHGatherRecord.identifier == HarvestObject.guid,
+                                     OAIPMHGatherRecord.harvest_source_id == harvest_source_id,
+                                     OAIPMHGatherRecord.set_spec.in_(set_specs))))
+
+
+def has_unimported_objects(harvest_job_id, except_object_id=None):
+    ''' Whether objects of a harvest job are still waiting for fetch or
+    import, or being imported, other than the given object '''
+    HarvestObject = harvest_model.HarvestObject
+    query = Session.query(HarvestObject.id) \
+        .filter(HarvestObject.harvest_job_id == harvest_job_id) \
+        .filter(HarvestObject.state.in_(UNIMPORTED_STATES))
+    if except_object_id is not None:
+        query = query.filter(HarvestObject.id != except_object_id)
+    return query.first() is not None
+
+
+def oldest_failed_datestamp(harvest_job_id):
+    ''' Return the oldest header datestamp of the failed objects of a
+    harvest job, or None '''
+    HarvestObject = harvest_model.HarvestObject
+    return Session.query(func.min(HarvestObject.metadata_modified_date)) \
+        .filter(HarvestObject.harvest_job_id == harvest_job_id) \
+        .filter(HarvestObject.state == u'ERROR') \
+        .scalar()
@@ -0,0 +1,89 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import threading
+
+import oaipmh.common
+from ckan import plugins as p
+from pylons import config
+
+from ckanext.oaipmh.interfaces import IOAIPMHHarvester
+
+_lock = threading.Lock()
+_implementations = None
+
+
+def harvester_plugins():
+    ''' Return the plugins implementing IOAIPMHHarvester.
+
+    The plugins are resolved once per process.
+    '''
+    global _implementations
+    with _lock:
+        if _implementations is None:
+            _implementations = list(p.PluginImplementations(IOAIPMHHarvester))
+        return _implementations
+
+
+def clear_plugin_cache():
+    ''' Resolve the plugins again on next use, after loading or unloading plugins '''
+    global _implementations
+    with _lock:
+        _implementations = None
+
+
+def get_package_dicts(md_format, elements):
+    ''' Map metadata elements to package dicts with the IOAIPMHHarvester plugins.
+
+    Plugins with get_oaipmh_package_dicts map all elements in one call,
+    others are called once per element. If several plugins implement the
+    interface, the dicts of the last one are used.
+
+    :param md_format: metadata format of the elements (e.g. cmdi0571)
+    :param elements: list of metadata elements (lxml)
+    :returns: list of package dicts, in the order of the elements
+    '''
+    package_dicts = [{} for _ in elements]
+    for plugin in harvester_plugins():
+        get_many = getattr(plugin, 'get_oaipmh_package_dicts', None)
+        if get_many is not None:
+            package_dicts = list(get_many(md_format, elements))
+        else:
+            package_dicts = [plugin.get_oaipmh_package_dict(md_format, element) for element in elements]
+    return package_dicts
+
+
+class PluginReader(object):
+    """ Base of readers whose package dicts are made by IOAIPMHHarvester plugins """
+
+    md_format = None
+
+    def __init__(self, provider=None):
+        """ Generate new reader instance.
+        :param provider: URL used for pids.
+        """
+        super(PluginReader, self).__init__()
+        self.provider = provider or config.get('ckan.site_url')
+
+    def __call__(self, xml):
+        """ Call :meth:`PluginReader.read`. """
+        return self.read(xml)
+
+    def read(self, xml):
+        """ Extract package data from given XML.
+        :param xml: xml element (lxml)
+        :return: oaipmh.common.Metadata object generated from xml
+        """
+        return self.read_many([xml])[0]
+
+    def read_many(self, xmls):
+        """ Extract package data from many XML elements at once.
+        :param xmls: list of xml elements (lxml)
+        :return: list of oaipmh.common.Metadata objects, in the order of xmls
+        """
+        package_dicts = get_package_dicts(self.md_format, xmls)
+        return [oaipmh.common.Metadata(xml, package_dict) for xml, package_dict in zip(xmls, package_dicts)]
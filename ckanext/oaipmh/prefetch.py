@@ -0,0 +1,99 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from ckan import model
+from ckanext.harvest.model import HarvestObject
+from ckanext.oaipmh.model import binary_ordered
+
+log = logging.getLogger(__name__)
+
+# How many records are fetched ahead per concurrent request
+LOOKAHEAD_FACTOR = 2
+RESULT_TIMEOUT = 3600
+
+_lock = threading.Lock()
+_prefetchers = {}
+
+
+class RecordPrefetcher(object):
+    ''' Fetches records of a harvest job ahead of the fetch stage.
+
+    When the record of a harvest object is requested, requests for the
+    next waiting objects of the same job are started in a thread pool, so
+    that the network requests overlap with the rest of the harvesting.
+    Gather stage queues the objects in the order of their identifiers,
+    which is also the order in which they are fetched ahead.
+
+    Only network requests are made in the threads; the database is
+    accessed from the calling thread only.
+    '''
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.lookahead = concurrency * LOOKAHEAD_FACTOR
+        self.pool = ThreadPool(concurrency)
+        self.job_id = None
+        self.pending = {}
+
+    def fetch(self, harvest_object, fetch_record):
+        ''' Return the record of a harvest object.
+
+        :param harvest_object: HarvestObject object
+        :param fetch_record: function fetching the record of an identifier
+        :returns: return value of fetch_record for the object's identifier
+        '''
+        guid = harvest_object.guid
+        if harvest_object.harvest_job_id != self.job_id:
+            self.job_id = harvest_object.harvest_job_id
+            self.pending = {}
+
+        result = self.pending.pop(guid, None)
+        # Objects before this one have been fetched by someone else already
+        for passed in [g for g in self.pending if g < guid]:
+            del self.pending[passed]
+        self._fetch_ahead(harvest_object, fetch_record)
+
+        if result is None:
+            return fetch_record(guid)
+        return result.get(RESULT_TIMEOUT)
+
+    def _fetch_ahead(self, harvest_object, fetch_record):
+        if len(self.pending) >= self.lookahead:
+            return
+        # Identifiers are compared like in Python, in which gather sorts them
+        guid = binary_ordered(HarvestObject.guid)
+        waiting = model.Session.query(HarvestObject.guid) \
+            .filter(HarvestObject.harvest_job_id == harvest_object.harvest_job_id) \
+            .filter(HarvestObject.state == u'WAITING') \
+            .filter(guid > harvest_object.guid) \
+            .order_by(guid) \
+            .limit(self.lookahead)
+        for (guid,) in waiting:
+            if len(self.pending) >= self.lookahead:
+                break
+            if guid not in self.pending:
+                self.pending[guid] = self.pool.apply_async(fetch_record, (guid,))
+
+
+def get_prefetcher(harvest_source_id, concurrency):
+    ''' Return the prefetcher of a harvest source in this process.
+
+    Each source has its own thread pool, which limits the number of
+    concurrent requests to the source.
+    '''
+    with _lock:
+        prefetcher = _prefetchers.get(harvest_source_id)
+        if prefetcher is None or prefetcher.concurrency != concurrency:
+            if prefetcher is not None:
+                prefetcher.pool.close()
+            prefetcher = RecordPrefetcher(concurrency)
+            _prefetchers[harvest_source_id] = prefetcher
+        return prefetcher
@@ -0,0 +1,112 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import base64
+import hashlib
+import json
+import logging
+import zlib
+
+log = logging.getLogger(__name__)
+
+# Package dicts stored as harvest object content are serialized with ujson
+# if it is installed, as it is considerably faster than the standard library
+# with the large dicts mapped from CMDI and DDI records. Keys are sorted, so
+# that the digest of the content can be used for detecting changes.
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if ujson is not None:
+    def dumps(package_dict):
+        ''' Serialize a package dict to a JSON string with sorted keys '''
+        return ujson.dumps(package_dict, sort_keys=True, escape_forward_slashes=False)
+
+    loads = ujson.loads
+else:
+    def dumps(package_dict):
+        ''' Serialize a package dict to a JSON string with sorted keys '''
+        return json.dumps(package_dict, sort_keys=True, separators=(',', ':'))
+
+    loads = json.loads
+
+# Compressed content is stored as text, base64 encoded and prefixed with the
+# name of the compression, which neither JSON nor XML content can begin with
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def content_digest(content):
+    ''' Return a hexadecimal SHA-256 digest of serialized content '''
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def package_digest(package_dict):
+    ''' Return a digest of a package dict which does not depend on key order.
+
+    :param package_dict: mapped package dict or metadata map
+    :type package_dict: dict
+    :returns: hexadecimal SHA-256 digest
+    :rtype: string
+    '''
+    return content_digest(dumps(package_dict))
+
+
+def compress_content(content, compression):
+    ''' Compress serialized content for storing in a text column.
+
+    zstd requires the zstandard package; zlib is used instead if it is
+    not installed.
+
+    :param content: serialized content
+    :param compression: ZLIB, ZSTD, or None for no compression
+    :returns: content, compressed if compression is given
+    '''
+    if not compression or content is None:
+        return content
+    if compression not in (ZLIB, ZSTD):
+        raise ValueError('Unknown content compression: {0}'.format(compression))
+    if compression == ZSTD and zstandard is None:
+        log.warning('zstandard is not installed, compressing content with zlib')
+        compression = ZLIB
+
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    if compression == ZSTD:
+        data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(content)
+    else:
+        data = zlib.compress(content, ZLIB_LEVEL)
+    return u'{0}:{1}'.format(compression, base64.b64encode(data))
+
+
+def decode_content(content):
+    ''' Return stored content, decompressed if it was stored compressed.
+
+    :param content: harvest object content
+    :returns: the content as written before compression
+    '''
+    if not content or not content.startswith((ZLIB + ':', ZSTD + ':')):
+        return content
+    compression, data = content.split(':', 1)
+    data = base64.b64decode(data)
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ValueError('Content is compressed with zstd, but zstandard is not installed')
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+    return data.decode('utf-8')
@@ -0,0 +1,207 @@
+# This file is part of the Etsin harvester service
+#
+# Copyright 2017-2018 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: GNU Affero General Public License version 3
+
+import fnmatch
+import hashlib
+import json
+import logging
+import re
+import threading
+
+from ckanext.oaipmh import serialization
+from ckanext.oaipmh.incremental import parse_date
+
+log = logging.getLogger(__name__)
+
+MAX_CACHED_CONFIGS = 256
+# Part of a wildcard pattern before its first wildcard
+_LITERAL_PREFIX = re.compile(r'[^*?[]*')
+
+# Options which must be integers or numbers, and options with fixed choices
+INTEGER_OPTIONS = ('fetch_concurrency', 'gather_chunk_size', 'gather_workers', 'import_batch_size',
+                   'index_batch_size', 'limit', 'max_retries')
+NUMBER_OPTIONS = ('delete_missing_max_fraction', 'object_retention_days', 'requests_per_second',
+                  'retry_backoff')
+CHOICE_OPTIONS = {
+    'content_compression': (serialization.ZLIB, serialization.ZSTD),
+    'gather_mode': ('identifiers', 'records'),
+}
+DATE_OPTIONS = ('from', 'until')
+
+_lock = threading.Lock()
+_configs = {}
+
+
+def _digest(config):
+    if isinstance(config, unicode):
+        config = config.encode('utf-8')
+    return hashlib.sha1(config or '').hexdigest()
+
+
+def _translate(pattern):
+    ''' Translate a wildcard pattern to a regular expression without flags '''
+    regex = fnmatch.translate(pattern)
+    if regex.endswith('(?ms)'):
+        regex = regex[:-len('(?ms)')]
+    return regex
+
+
+class SetMatcher(object):
+    ''' Picks the sets to harvest from the sets of a source.
+
+    Set ids with '*' are wildcard patterns. The patterns are compiled once
+    and indexed by the literal prefix before their first wildcard, so that
+    each available set is compared only with the patterns whose prefix it
+    starts with. Patterns which are only a prefix and '*' are matched
+    without regular expressions.
+
+    :param set_ids: set ids and patterns of the source configuration
+    '''
+
+    def __init__(self, set_ids):
+        self.set_ids = [set_id for set_id in set_ids if '*' not in set_id]
+        self.patterns = [set_id for set_id in set_ids if '*' in set_id]
+        # Prefix length -> prefix -> [(pattern index, regex or None)]
+        self._by_prefix = {}
+        for index, pattern in enumerate(self.patterns):
+            prefix = _LITERAL_PREFIX.match(pattern).group()
+            regex = None if pattern == prefix + '*' else re.compile(_translate(pattern), re.S)
+            self._by_prefix.setdefault(len(prefix), {}).setdefault(prefix, []).append((index, regex))
+        self._by_prefix = sorted(self._by_prefix.items())
+
+    def match(self, available_sets):
+        ''' Match the configured sets with the sets listed by the source.
+
+        :param available_sets: (setSpec, setName, setDescription) tuples
+                               from ListSets
+        :returns: (set specs to harvest, configured set ids not listed by
+                  the source, patterns which matched no set)
+        :rtype: (set, list, list)
+        '''
+        set_ids = set(self.set_ids)
+        listed = set()
+        matched = set()
+        for available_set in available_sets:
+            listed.update(available_set)
+            set_spec = available_set[0]
+            for length, patterns in self._by_prefix:
+                if length > len(set_spec):
+                    break
+                for index, regex in patterns.get(set_spec[:length], ()):
+                    if regex is None or regex.match(set_spec):
+                        set_ids.add(set_spec)
+                        matched.add(index)
+
+        unlisted = [set_id for set_id in self.set_ids if set_id not in listed]
+        unmatched = [pattern for index, pattern in enumerate(self.patterns) if index not in matched]
+        return set_ids, unlisted, unmatched
+
+
+class SourceConfig(dict):
+    ''' Parsed and validated configuration of a harvest source.
+
+    Used as a dict of the configuration options.
+
+    :param options: dict of configuration options
+    :param digest: hash of the configuration as stored on the source
+    '''
+
+    def __init__(self, options, digest):
+        super(SourceConfig, self).__init__(options)
+        self.digest = digest
+        self.set_matcher = SetMatcher(self.get('set', []))
+
+
+def _validate(options):
+    ''' Validate configuration options and convert the numeric ones.
+
+    Numeric options given as strings are converted to numbers, and empty
+    numeric options are left out, so that their defaults are used.
+
+    :returns: the options with typed values
+    :rtype: dict
+    :raises ValueError: if the options have invalid values
+    '''
+    if not isinstance(options, dict):
+        raise ValueError('Configuration must be a JSON object')
+    options = dict(options)
+    for name, value in options.items():
+        if value is None or value == u'':
+            if name in INTEGER_OPTIONS or name in NUMBER_OPTIONS:
+                del options[name]
+            continue
+        try:
+            if name in INTEGER_OPTIONS:
+                options[name] = _integer(value)
+            elif name in NUMBER_OPTIONS:
+                options[name] = float(value)
+            elif name in DATE_OPTIONS:
+                parse_date(value)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError('Invalid value for {0}: {1!r}'.format(name, value))
+        if name in CHOICE_OPTIONS and value not in CHOICE_OPTIONS[name]:
+            raise ValueError('{0} must be one of {1}, not {2!r}'.format(
+                name, ', '.join(CHOICE_OPTIONS[name]), value))
+    set_ids = options.get('set', [])
+    if not isinstance(set_ids, list) or not all(isinstance(set_id, basestring) for set_id in set_ids):
+        raise ValueError('set must be a list of set ids')
+    return options
+
+
+def _integer(value):
+    ''' Convert an integer option, which must not have a fraction '''
+    number = float(value)
+    if isinstance(value, bool) or number != int(number):
+        raise ValueError(value)
+    return int(number)
+
+
+def parse(config, digest=None):
+    ''' Parse and validate the configuration of a harvest source.
+
+    :param config: configuration as stored on the source, a JSON string
+    :param digest: hash of config, if already computed
+    :returns: parsed configuration
+    :rtype: SourceConfig
+    :raises ValueError: if the configuration is not valid
+    '''
+    options = _validate(json.loads(config) if config else {})
+    return SourceConfig(options, digest or _digest(config))
+
+
+def get(harvest_source_id, config):
+    ''' Return the parsed configuration of a harvest source.
+
+    Configurations are cached per process by source id, and parsed again
+    when the configuration of the source changes. The returned object is
+    shared, and must not be modified.
+
+    :param harvest_source_id: id of the harvest source
+    :param config: configuration as stored on the source, a JSON string
+    :returns: parsed configuration
+    :rtype: SourceConfig
+    :raises ValueError: if the configuration is not valid
+    '''
+    digest = _digest(config)
+    with _lock:
+        cached = _configs.get(harvest_source_id)
+    if cached is not None and cached.digest == digest:
+        return cached
+
+    log.debug('Config: %s', config)
+    parsed = parse(config, digest)
+    with _lock:
+        if len(_configs) >= MAX_CACHED_CONFIGS:
+            _configs.clear()
+        _configs[harvest_source_id] = parsed
+    return parsed
+
+
+def clear_cache():
+    ''' Forget all parsed configurations '''
+    with _lock:
+        _configs.clear()
@@ -12,15 +12,28 @@
 Unit tests for OAI-PMH harvester.
 """
 
+import datetime
+import email.utils
 from unittest import TestCase
+import mock
+import oaipmh.client
+import oaipmh.error
+import requests
 from lxml import etree
+from sqlalchemy.dialects import postgresql
 from pylons import config
 import ckan
-from ckanext.harvest.model import HarvestJob, HarvestSource, HarvestObject
+from ckanext.harvest.model import HarvestJob, HarvestSource, HarvestObject, HarvestObjectExtra
 from ckanext.oaipmh.cmdi import CMDIHarvester
+from ckanext.oaipmh.datacite import DataCiteHarvester
 from ckanext.oaipmh.cmdi_reader import CmdiReader
+from ckanext.oaipmh.importformats import create_metadata_registry, copy_element, person_attrs, CopyPlan, PERSON_ATTRS
+from ckanext.oaipmh.importcore import generic_rdf_metadata_reader, generic_xml_metadata_reader
+from ckanext.oaipmh.incremental import HarvestWindow, promote_high_water_marks
+from ckanext.oaipmh import clients, indexing, plugin_reader, serialization, source_config
 import ckanext.harvest.model as harvest_model
 import ckanext.kata.model as kata_model
+import ckanext.oaipmh.model as oaipmh_model
 import os
 from ckan import model
 from ckan.logic import get_action
@@ -36,25 +49,81 @@ def _get_record(filename):
     return tree.xpath('/oai:OAI-PMH/*/oai:record', namespaces={'oai': 'http://www.openarchives.org/OAI/2.0/'})[0]
 
 
+def _record_xml(identifier, datestamp, deleted=False):
+    ''' Serialized OAI-PMH record, as stored on harvest objects in records mode '''
+    status = ' status="deleted"' if deleted else ''
+    metadata = '' if deleted else '<metadata><cmd:CMD xmlns:cmd="http://www.clarin.eu/cmd/"/></metadata>'
+    return (u'<record xmlns="http://www.openarchives.org/OAI/2.0/"><header{status}><identifier>{identifier}'
+            u'</identifier><datestamp>{datestamp}</datestamp></header>{metadata}</record>').format(
+        status=status, identifier=identifier, datestamp=datestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        metadata=metadata)
+
+
 class _FakeIdentifier():
-    def __init__(self, identifier):
+    def __init__(self, identifier, datestamp=datetime.datetime(2014, 10, 20, 1, 1, 15), deleted=False):
         self._identifier = identifier
+        self._datestamp = datestamp
+        self._deleted = deleted
 
     def identifier(self):
         return self._identifier
 
+    def datestamp(self):
+        return self._datestamp
+
+    def isDeleted(self):
+        return self._deleted
+
 
 class _FakeClient():
     def listIdentifiers(self, metadataPrefix):
         return [_FakeIdentifier('oai:kielipankki.fi:sha3a880')]
 
 
+class _FakeListingClient():
+    ''' Client listing the given pages of headers with ListIdentifiers '''
+    _day_granularity = False
+
+    def __init__(self, *pages):
+        self.pages = pages
+        self.requests = []
+
+    def getNamespaces(self):
+        return {}
+
+    def updateGranularity(self):
+        pass
+
+    def makeRequestErrorHandling(self, **kwargs):
+        self.requests.append(kwargs)
+        if 'resumptionToken' in kwargs:
+            return int(kwargs['resumptionToken'])
+        if not self.pages:
+            raise oaipmh.error.NoRecordsMatchError()
+        return 0
+
+    def getMetadataRegistry(self):
+        return None
+
+    def buildIdentifiers(self, namespaces, page):
+        token = str(page + 1) if page + 1 < len(self.pages) else None
+        return self.pages[page], token
+
+    def buildRecords(self, metadataPrefix, namespaces, registry, page):
+        ''' Build (header, metadata, about) of pages of serialized records '''
+        records, token = self.buildIdentifiers(namespaces, page)
+        namespaces = {'oai': 'http://www.openarchives.org/OAI/2.0/'}
+        return [(oaipmh.client.buildHeader(etree.fromstring(record).find('oai:header', namespaces), namespaces),
+                 None, None) for record in records], token
+
+
 class TestCMDIHarvester(TestCase):
     @classmethod
     def setup_class(cls):
         ''' Setup database and variables '''
         harvest_model.setup()
         kata_model.setup()
+        oaipmh_model.setup()
         cls.harvester = CMDIHarvester()
 
     def tearDown(self):
@@ -93,6 +162,16 @@ class TestCMDIHarvester(TestCase):
         self.assertEquals(package.get('version', None), '2012-09-07')
         self.assertEquals(package.get('title', []), '{"eng": "Longi Corpus"}')
 
+    def test_read_stored_record(self):
+        harvest_object = HarvestObject(content=etree.tostring(_get_record("cmdi_1.xml"), encoding=unicode))
+        header, metadata, _about = self.harvester.read_stored_record(harvest_object, create_metadata_registry())
+        self.assertEquals(header.identifier(), 'oai:kielipankki.fi:sha3a880')
+        self.assertFalse(header.isDeleted())
+        self.assertEquals(metadata.element().tag, '{http://www.openarchives.org/OAI/2.0/}metadata')
+
+        harvest_object = HarvestObject(content=None)
+        self.assertEquals(self.harvester.read_stored_record(harvest_object, None), None)
+
     def test_gather(self):
         source = HarvestSource(url="http://localhost/test_cmdi", type="cmdi")
         source.save()
@@ -156,6 +235,26 @@ class TestCMDIHarvester(TestCase):
         model.Session.flush()
         self.assertEquals(model.Package.get(package['id']).state, 'deleted')
 
+    def test_set_object_extra(self):
+        source = HarvestSource(url="http://localhost/test_cmdi", type="cmdi")
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+        harvest_object = HarvestObject(guid=u'oai:test:1', job=job, source=source)
+        harvest_object.extras.append(HarvestObjectExtra(key=u'content_hash', value=u'old'))
+        harvest_object.extras.append(HarvestObjectExtra(key=u'content_hash', value=u'older'))
+        harvest_object.save()
+
+        # A retried import replaces the digest of the previous attempt
+        self.harvester._set_object_extra(harvest_object, 'content_hash', u'new')
+        harvest_object.save()
+        model.Session.expire_all()
+
+        harvest_object = HarvestObject.get(harvest_object.id)
+        self.assertEquals([extra.value for extra in harvest_object.extras if extra.key == u'content_hash'],
+                          [u'new'])
+        self.assertEquals(self.harvester._get_object_extra(harvest_object, 'content_hash'), u'new')
+
     def test_fetch_xml(self):
         package = self.harvester.fetch_xml("file://%s" % _get_fixture('cmdi_1.xml'), {})
         self.assertEquals(package.get('notes', None), '{"eng": "Test description"}')
@@ -166,3 +265,575 @@ class TestCMDIHarvester(TestCase):
             package = self.harvester.parse_xml(source.read(), {})
             self.assertEquals(package.get('notes', None), '{"eng": "Test description"}')
             self.assertEquals(package.get('version', None), '2012-09-07')
+
+
+class TestHarvestWindow(TestCase):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+        oaipmh_model.setup()
+
+    def tearDown(self):
+        ckan.model.repo.rebuild_db()
+
+    def test_high_water_marks(self):
+        source = HarvestSource(url="http://localhost/test_cmdi", type="cmdi")
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+
+        window = HarvestWindow(source.id, {'incremental': True, 'from': '2010-01-01'})
+        self.assertEquals(window.list_kwargs(None), {'from_': datetime.datetime(2010, 1, 1)})
+        window.observe(None, datetime.datetime(2014, 1, 1))
+        window.observe('set', datetime.datetime(2015, 1, 1))
+        window.observe('set', datetime.datetime(2013, 1, 1))
+        window.save(job.id)
+        promote_high_water_marks(source.id)
+        model.Session.commit()
+
+        window = HarvestWindow(source.id, {'incremental': True, 'until': '2016-01-01'})
+        self.assertEquals(window.list_kwargs(None), {'from_': datetime.datetime(2014, 1, 1),
+                                                     'until': datetime.datetime(2016, 1, 1)})
+        self.assertEquals(window.list_kwargs('set'), {'from_': datetime.datetime(2015, 1, 1),
+                                                      'until': datetime.datetime(2016, 1, 1)})
+        self.assertEquals(window.list_kwargs('other'), {'until': datetime.datetime(2016, 1, 1)})
+
+        window = HarvestWindow(source.id, {'incremental': True, 'full_resync': True})
+        self.assertEquals(window.list_kwargs('set'), {})
+
+    def test_marks_wait_for_import(self):
+        source = HarvestSource(url=u'http://localhost/test_cmdi', type=u'cmdi', config=u'{"incremental": true}')
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+        waiting = HarvestObject(guid=u'oai:test:1', job=job, source=source, state=u'WAITING',
+                                metadata_modified_date=datetime.datetime(2017, 1, 5))
+        waiting.save()
+        HarvestObject(guid=u'oai:test:2', job=job, source=source, state=u'ERROR',
+                      metadata_modified_date=datetime.datetime(2017, 1, 7)).save()
+
+        window = HarvestWindow(source.id, {'incremental': True})
+        window.observe(None, datetime.datetime(2017, 1, 10))
+        window.save(job.id)
+        promote_high_water_marks(source.id)
+        model.Session.commit()
+        self.assertEquals(window.list_kwargs(None), {})
+
+        # The last object of the job fails too, and the mark is its datestamp
+        waiting.state = u'IMPORT'
+        waiting.save()
+        with mock.patch.object(CMDIHarvester, '_import_stage', return_value=False):
+            self.assertFalse(CMDIHarvester().import_stage(waiting))
+        self.assertEquals(window.list_kwargs(None), {'from_': datetime.datetime(2017, 1, 5)})
+        state = oaipmh_model.OAIPMHHarvestState.get_for(source.id, None)
+        self.assertEquals((state.pending_datestamp, state.pending_job_id), (None, None))
+
+
+class TestGather(TestCase):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+        oaipmh_model.setup()
+        cls.harvester = CMDIHarvester()
+
+    def tearDown(self):
+        ckan.model.repo.rebuild_db()
+
+    def _job(self, config):
+        source = HarvestSource(url=u'http://localhost/test_cmdi', type=u'cmdi', config=config)
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+        return job
+
+    def _gather(self, job, client):
+        config = source_config.parse(job.source.config)
+        return self.harvester.populate_harvest_job(job, set(), config, client)
+
+    def _harvested(self, job, guid, modified=datetime.datetime(2017, 1, 1)):
+        ''' Create the current harvest object of a record imported earlier '''
+        harvest_object = HarvestObject(guid=guid, job=job, source=job.source, state=u'COMPLETE', current=True,
+                                       package_id=u'package-' + guid, metadata_modified_date=modified)
+        harvest_object.save()
+        return harvest_object
+
+    def _objects(self, job):
+        ''' Return the harvest objects of a job by identifier '''
+        return dict((harvest_object.guid, harvest_object) for harvest_object in
+                    model.Session.query(HarvestObject).filter(HarvestObject.harvest_job_id == job.id))
+
+    def _deleted_package_ids(self, action):
+        return sorted(data_dict['id'] for (_context, data_dict), _ in action.call_args_list)
+
+    def test_deleted_records(self):
+        for streaming in ('false', 'true'):
+            earlier_job = self._job(u'{"gather_streaming": %s}' % streaming)
+            job = HarvestJob(source=earlier_job.source)
+            job.save()
+            harvested = self._harvested(earlier_job, u'oai:test:1')
+            self._harvested(earlier_job, u'oai:test:2')
+            client = _FakeListingClient([_FakeIdentifier(u'oai:test:1', deleted=True),
+                                         _FakeIdentifier(u'oai:test:2', datetime.datetime(2017, 1, 2)),
+                                         _FakeIdentifier(u'oai:test:3', deleted=True),
+                                         _FakeIdentifier(u'oai:test:4')])
+            with mock.patch('ckanext.oaipmh.harvester.p.toolkit.get_action') as get_action:
+                object_ids = self._gather(job, client)
+            get_action.assert_called_with('package_delete')
+            self.assertEquals(self._deleted_package_ids(get_action.return_value), [u'package-oai:test:1'])
+
+            # The deleted record is not fetched, and the never harvested
+            # deleted record gets no object at all
+            objects = self._objects(job)
+            self.assertEquals(sorted(objects), [u'oai:test:1', u'oai:test:2', u'oai:test:4'])
+            self.assertEquals(sorted(HarvestObject.get(object_id).guid for object_id in object_ids),
+                              [u'oai:test:2', u'oai:test:4'])
+            self.assertEquals((objects[u'oai:test:1'].state, objects[u'oai:test:1'].report_status),
+                              (u'COMPLETE', u'deleted'))
+            model.Session.refresh(harvested)
+            self.assertFalse(harvested.current)
+
+    def _gather_missing(self, config, listed):
+        ''' Gather a source of ten harvested records which lists only the
+        given ones, and return the package ids deleted as missing '''
+        earlier_job = self._job(config)
+        job = HarvestJob(source=earlier_job.source)
+        job.save()
+        for i in range(10):
+            self._harvested(earlier_job, u'oai:test:%d' % i)
+        client = _FakeListingClient([_FakeIdentifier(u'oai:test:%d' % i, datetime.datetime(2017, 1, 1))
+                                     for i in listed])
+        with mock.patch('ckanext.oaipmh.harvester.p.toolkit.get_action') as get_action, \
+                mock.patch.object(self.harvester, '_save_gather_error') as save_gather_error:
+            self._gather(job, client)
+        return self._deleted_package_ids(get_action.return_value), save_gather_error
+
+    def test_missing_records(self):
+        for streaming in ('false', 'true'):
+            config = u'{"delete_missing": true, "gather_streaming": %s%s}'
+            deleted, error = self._gather_missing(config % (streaming, u''), range(1, 10))
+            self.assertEquals(deleted, [u'package-oai:test:0'])
+            self.assertFalse(error.called)
+
+            # Too many missing records
+            deleted, error = self._gather_missing(config % (streaming, u''), range(2, 10))
+            self.assertEquals(deleted, [])
+            self.assertTrue(error.called)
+
+            # Only part of the source is listed
+            for restriction in (u', "from": "2016-01-01"', u', "until": "2018-01-01"', u', "incremental": true'):
+                deleted, error = self._gather_missing(config % (streaming, restriction), range(1, 10))
+                self.assertEquals(deleted, [])
+
+    def _gather_changes(self, streaming):
+        ''' Gather unchanged, changed, deleted, missing and new records, and
+        return the deleted package ids and the created objects '''
+        earlier_job = self._job(u'{"delete_missing": true, "delete_missing_max_fraction": 0.5, '
+                                u'"gather_streaming": %s}' % streaming)
+        job = HarvestJob(source=earlier_job.source)
+        job.save()
+        previous = dict((guid, self._harvested(earlier_job, guid).id)
+                        for guid in (u'oai:test:unchanged', u'oai:test:changed', u'oai:test:deleted',
+                                     u'oai:test:missing'))
+        client = _FakeListingClient([_FakeIdentifier(u'oai:test:unchanged', datetime.datetime(2017, 1, 1)),
+                                     _FakeIdentifier(u'oai:test:new', datetime.datetime(2017, 1, 3)),
+                                     _FakeIdentifier(u'oai:test:deleted', deleted=True)],
+                                    [_FakeIdentifier(u'oai:test:changed', datetime.datetime(2017, 1, 2))])
+        with mock.patch('ckanext.oaipmh.harvester.p.toolkit.get_action') as get_action:
+            self._gather(job, client)
+        objects = []
+        for guid, harvest_object in sorted(self._objects(job).items()):
+            extras = dict((extra.key, extra.value) for extra in harvest_object.extras)
+            previous_object_id = extras.get('previous_object_id')
+            objects.append((guid, harvest_object.state, extras['status'],
+                            previous_object_id and previous_object_id == previous[guid],
+                            harvest_object.package_id, harvest_object.metadata_modified_date))
+        return self._deleted_package_ids(get_action.return_value), objects
+
+    def test_streaming_matches_in_memory(self):
+        in_memory = self._gather_changes('false')
+        self.assertEquals(in_memory, self._gather_changes('true'))
+        self.assertEquals(in_memory, (
+            [u'package-oai:test:deleted', u'package-oai:test:missing'],
+            [(u'oai:test:changed', u'WAITING', u'change', True, u'package-oai:test:changed',
+              datetime.datetime(2017, 1, 2)),
+             (u'oai:test:deleted', u'COMPLETE', u'delete', None, u'package-oai:test:deleted', None),
+             (u'oai:test:missing', u'COMPLETE', u'delete', None, u'package-oai:test:missing', None),
+             (u'oai:test:new', u'WAITING', u'new', None, None, datetime.datetime(2017, 1, 3))]))
+
+    def test_empty_listing_resets_checkpoints(self):
+        for streaming in ('false', 'true'):
+            job = self._job(u'{"gather_checkpoints": true, "incremental": true, "gather_streaming": %s}' %
+                            streaming)
+            self.assertEquals(self._gather(job, _FakeListingClient()), [])
+            state = oaipmh_model.OAIPMHHarvestState.get_for(job.source.id, None)
+            self.assertFalse(state.listing_done)
+
+            # The source is listed again in the next gather
+            client = _FakeListingClient([_FakeIdentifier(u'oai:test:1')])
+            self.assertEquals(len(self._gather(job, client)), 1)
+            self.assertEquals(len(client.requests), 1)
+
+    def test_records_mode_is_staged(self):
+        job = self._job(u'{"gather_mode": "records"}')
+        records = [_record_xml(u'oai:test:%d' % i, datetime.datetime(2017, 1, i)) for i in (1, 2, 3)]
+        client = _FakeListingClient(records[:2], records[2:])
+        with mock.patch.object(self.harvester, 'get_raw_client', return_value=client), \
+                mock.patch.object(self.harvester, 'populate_harvest_job_streaming',
+                                  wraps=self.harvester.populate_harvest_job_streaming) as streaming:
+            object_ids = self._gather(job, client)
+        self.assertTrue(streaming.called)
+        self.assertEquals(sorted(HarvestObject.get(object_id).content for object_id in object_ids), records)
+        self.assertEquals(model.Session.query(oaipmh_model.OAIPMHGatherRecord).count(), 0)
+
+
+class TestBinaryOrdered(TestCase):
+    def test_c_collation_on_postgresql(self):
+        with mock.patch.object(oaipmh_model, 'Session') as session:
+            session.bind.dialect.name = 'sqlite'
+            self.assertTrue(oaipmh_model.binary_ordered(HarvestObject.guid) is HarvestObject.guid)
+            session.bind.dialect.name = 'postgresql'
+            ordered = oaipmh_model.binary_ordered(HarvestObject.guid)
+        self.assertEquals(unicode(ordered.compile(dialect=postgresql.dialect())), u'harvest_object.guid COLLATE "C"')
+
+
+class TestImportObjects(TestCase):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+        oaipmh_model.setup()
+        cls.harvester = CMDIHarvester()
+
+    def tearDown(self):
+        ckan.model.repo.rebuild_db()
+
+    def test_failing_object_rolls_back_alone(self):
+        source = HarvestSource(url=u'http://localhost/test_cmdi', type=u'cmdi', config=u'{}')
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+        for guid, state in ((u'oai:test:1', u'WAITING'), (u'oai:test:2', u'FETCH'), (u'oai:test:3', u'WAITING'),
+                            (u'oai:test:4', u'COMPLETE')):
+            HarvestObject(guid=guid, job=job, source=source, content=u'gathered', state=state).save()
+
+        def import_stage(harvester, harvest_object):
+            harvest_object.content = u'imported'
+            harvest_object.add()
+            model.Session.flush()
+            if harvest_object.guid == u'oai:test:2':
+                raise Exception('Import failed')
+            return True
+
+        commit = model.Session.commit
+        with mock.patch.object(CMDIHarvester, 'import_stage', autospec=True, side_effect=import_stage) as stage, \
+                mock.patch.object(model.Session, 'commit', side_effect=commit) as commits:
+            self.assertEquals(self.harvester.import_job(job, batch_size=2), 2)
+        self.assertEquals([harvest_object.guid for (_, harvest_object), _ in stage.call_args_list],
+                          [u'oai:test:1', u'oai:test:2', u'oai:test:3'])
+        # The error of the failed object is committed with its batch
+        self.assertEquals(commits.call_count, 2)
+
+        model.Session.remove()
+        objects = dict((harvest_object.guid, harvest_object) for harvest_object in model.Session.query(HarvestObject))
+        self.assertEquals([(objects[guid].state, objects[guid].content) for guid in sorted(objects)],
+                          [(u'COMPLETE', u'imported'), (u'ERROR', u'gathered'), (u'COMPLETE', u'imported'),
+                           (u'COMPLETE', u'gathered')])
+        self.assertEquals(len(objects[u'oai:test:2'].errors), 1)
+
+
+class TestSerialization(TestCase):
+    def test_compressed_content(self):
+        content = serialization.dumps({'title': u'T\xe4st', 'notes': 'x' * 1000})
+        self.assertEquals(serialization.loads(content), {'title': u'T\xe4st', 'notes': 'x' * 1000})
+
+        compressed = serialization.compress_content(content, serialization.ZLIB)
+        self.assertTrue(compressed.startswith('zlib:'))
+        self.assertTrue(len(compressed) < len(content))
+        self.assertEquals(serialization.decode_content(compressed), content)
+        self.assertEquals(serialization.decode_content(content), content)
+        self.assertEquals(serialization.compress_content(content, None), content)
+
+
+class TestXmlReader(TestCase):
+    def test_nested_namespace_declarations(self):
+        document = u'''<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><!-- comment -->
+          <dc:title>Title</dc:title>
+          <record xmlns:ex="http://example.org/x/" ex:lang="fi"><ex:rel>Value</ex:rel><ex:rel>Other</ex:rel></record>
+          <dc:subject>Subject</dc:subject>
+        </metadata>'''
+        result = generic_xml_metadata_reader(etree.fromstring(document)).getMap()
+        self.assertEquals(result[u'metadata/dc:title'], u'Title')
+        self.assertEquals(result[u'metadata/record/@ex:lang'], u'fi')
+        self.assertEquals(result[u'metadata/record/ex:rel'], u'Value')
+        self.assertEquals(result[u'metadata/record/ex:rel.1'], u'Other')
+        self.assertEquals(result[u'metadata/dc:subject'], u'Subject')
+
+
+class TestRdfReader(TestCase):
+    def _read(self, subjects, extra=u''):
+        document = u'''<metadata><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+            xmlns:dct="http://purl.org/dc/terms/" xmlns:nrd="http://purl.org/net/nrd#"
+            xmlns:ex="http://example.org/x/">
+          <nrd:Dataset rdf:about="http://example.com/dataset">{0}<dct:title>Title</dct:title>{1}</nrd:Dataset>
+        </rdf:RDF></metadata>'''.format(u''.join(u'<dct:subject rdf:resource="http://example.com/%s"/>' % subject
+                                            for subject in subjects), extra)
+        return generic_rdf_metadata_reader(etree.fromstring(document)).getMap()
+
+    def test_arcs_in_sorted_order(self):
+        result = self._read([u'c', u'a', u'b', u'e', u'd'])
+        self.assertEquals(result, self._read([u'e', u'd', u'c', u'b', u'a']))
+        self.assertEquals([result[u'dataset/dct:subject'], result[u'dataset/dct:subject.1'],
+                           result[u'dataset/dct:subject.4']],
+                          [u'http://example.com/a', u'http://example.com/b', u'http://example.com/e'])
+        self.assertEquals(result[u'dataset/dct:title'], u'Title')
+
+    def test_document_namespaces(self):
+        result = self._read([], u'<ex:rel>Value</ex:rel>')
+        self.assertEquals(result[u'dataset/ex:rel'], u'Value')
+
+
+class TestCopyPlan(TestCase):
+    def test_plan_copies_like_copy_element(self):
+        md = {
+            u'dataset/nrd:creator.count': 2,
+            u'dataset/nrd:creator.0': u'a',
+            u'dataset/nrd:creator.0/foaf:name': u'Aino',
+            u'dataset/nrd:creator.0/foaf:name/@xml:lang': u'fi',
+            u'dataset/nrd:creator.1/@rdf:resource': u'http://example.com/b',
+            u'dataset/dct:title': u'Title',
+            u'dataset/dct:title/language.count': 1,
+            u'dataset/dct:title/language.0': u'en',
+        }
+        expected = dict(md)
+        copy_element(u'dataset/nrd:creator', u'creator', expected, person_attrs)
+        copy_element(u'dataset/dct:title', u'title', expected)
+
+        CopyPlan([(u'dataset/nrd:creator', u'creator', PERSON_ATTRS),
+                  (u'dataset/dct:title', u'title', None)]).apply(md)
+        self.assertEquals(md, expected)
+
+
+class TestPluginReader(TestCase):
+    class SinglePlugin(object):
+        def get_oaipmh_package_dict(self, format, etree_xml):
+            return {u'name': etree_xml.text, u'format': format}
+
+    class BatchPlugin(object):
+        def get_oaipmh_package_dicts(self, format, etree_xmls):
+            return [{u'name': etree_xml.text, u'batch_size': len(etree_xmls)} for etree_xml in etree_xmls]
+
+    def tearDown(self):
+        plugin_reader.clear_plugin_cache()
+        clients.clear_clients()
+
+    def test_last_plugin_wins(self):
+        elements = [etree.fromstring('<a>one</a>'), etree.fromstring('<a>two</a>')]
+        plugin_reader._implementations = [self.BatchPlugin(), self.SinglePlugin()]
+        self.assertEquals(CmdiReader().read_many(elements)[1].getMap(), {u'name': u'two', u'format': 'cmdi0571'})
+
+        plugin_reader._implementations = [self.SinglePlugin(), self.BatchPlugin()]
+        self.assertEquals([metadata.getMap() for metadata in CmdiReader().read_many(elements)],
+                          [{u'name': u'one', u'batch_size': 2}, {u'name': u'two', u'batch_size': 2}])
+
+    def test_prepare_records_maps_batch(self):
+        batch_plugin = self.BatchPlugin()
+        plugin_reader._implementations = [batch_plugin]
+        source = HarvestSource(id=u'batch-source', url=u'http://localhost/test_cmdi', type=u'cmdi', config=u'{}')
+        harvest_objects = [
+            HarvestObject(id=u'1', guid=u'oai:test:1', source=source,
+                          content=_record_xml(u'oai:test:1', datetime.datetime(2017, 1, 1))),
+            HarvestObject(id=u'2', guid=u'oai:test:2', source=source,
+                          content=_record_xml(u'oai:test:2', datetime.datetime(2017, 1, 1), deleted=True)),
+            HarvestObject(id=u'3', guid=u'oai:test:3', source=source,
+                          content=_record_xml(u'oai:test:3', datetime.datetime(2017, 1, 2))),
+            HarvestObject(id=u'4', guid=u'oai:test:4', source=source, content=None),
+        ]
+        harvester = CMDIHarvester()
+        with mock.patch.object(batch_plugin, 'get_oaipmh_package_dicts',
+                               wraps=batch_plugin.get_oaipmh_package_dicts) as get_many:
+            harvester._prepare_records(harvest_objects)
+
+        # Both records with metadata are mapped in one call
+        self.assertEquals(get_many.call_count, 1)
+        self.assertEquals(len(get_many.call_args[0][1]), 2)
+        prepared = harvester._prepared_records
+        self.assertEquals(sorted(prepared), [u'1', u'2', u'3'])
+        self.assertEquals(prepared[u'1'][1].getMap()[u'batch_size'], 2)
+        self.assertTrue(prepared[u'2'][0].isDeleted())
+        self.assertEquals(prepared[u'2'][1], None)
+        self.assertEquals(prepared[u'3'][0].identifier(), u'oai:test:3')
+
+
+class TestSourceConfig(TestCase):
+    def test_set_matcher(self):
+        available_sets = [(u'col:1', u'One', None), (u'col:2', u'Two', None), (u'other', u'Other', None)]
+        matcher = source_config.SetMatcher([u'col:*', u'c?l:2*', u'x*', u'other', u'missing'])
+        self.assertEquals(matcher.match(available_sets),
+                          (set([u'col:1', u'col:2', u'other', u'missing']), [u'missing'], [u'x*']))
+
+    def test_invalid_config(self):
+        self.assertRaises(ValueError, source_config.parse, '{"set": "col:1"}')
+        self.assertRaises(ValueError, source_config.parse, '{"gather_workers": "many"}')
+        self.assertRaises(ValueError, source_config.parse, '{"gather_chunk_size": 1.7}')
+
+    def test_typed_options(self):
+        config = source_config.parse('{"gather_chunk_size": "500", "gather_workers": 4.0, '
+                                     '"retry_backoff": "1.5", "max_retries": "", "set": ["a"]}')
+        self.assertEquals(config, {u'gather_chunk_size': 500, u'gather_workers': 4, u'retry_backoff': 1.5,
+                                   u'set': [u'a']})
+        self.assertTrue(isinstance(config['gather_chunk_size'], int))
+
+
+class TestClients(TestCase):
+    def tearDown(self):
+        clients.clear_clients()
+
+    def test_raw_clients_by_format(self):
+        source = HarvestSource(url=u'http://localhost/oai', config=u'')
+        job = HarvestJob(source=source)
+        cmdi_client = CMDIHarvester().get_raw_client({}, job)
+        datacite_client = DataCiteHarvester().get_raw_client({}, job)
+        self.assertFalse(cmdi_client is datacite_client)
+        self.assertTrue(datacite_client.getMetadataRegistry().hasReader('oai_datacite'))
+        self.assertTrue(cmdi_client is CMDIHarvester().get_raw_client({}, job))
+
+
+class _FakeClock(object):
+    ''' Replaces time.time and time.sleep of the clients module '''
+
+    def __init__(self):
+        self.now = 1500000000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _response(status_code, content='', headers=None):
+    response = mock.Mock(status_code=status_code, reason='Reason', content=content, headers=headers or {})
+    if status_code >= 400:
+        response.raise_for_status.side_effect = requests.HTTPError(str(status_code), response=response)
+    return response
+
+
+class TestRequestScheduling(TestCase):
+    def setUp(self):
+        self.clock = _FakeClock()
+        self.patcher = mock.patch.multiple('ckanext.oaipmh.clients.time', time=self.clock.time,
+                                           sleep=self.clock.sleep)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_rate_limit(self):
+        scheduler = clients.RequestScheduler(rate=2)
+        for _ in range(5):
+            scheduler.acquire()
+        self.assertAlmostEquals(sum(self.clock.sleeps), 2.0)
+
+        # Throttling pauses the requests and halves the rate, which recovers
+        # with successful requests
+        scheduler.throttle(10)
+        self.assertEquals(scheduler.rate, 1.0)
+        start = self.clock.now
+        scheduler.acquire()
+        self.assertTrue(self.clock.now - start >= 10)
+        for _ in range(10):
+            scheduler.recover()
+        self.assertAlmostEquals(scheduler.rate, 2.0)
+
+        scheduler.throttle(1)
+        scheduler.throttle(1)
+        scheduler.throttle(1)
+        scheduler.throttle(1)
+        self.assertAlmostEquals(scheduler.rate, 2.0 * clients.MIN_RATE_FRACTION)
+
+    def test_retry_after(self):
+        self.assertEquals(clients.retry_after(_response(503, headers={'Retry-After': '120'})), 120)
+        self.assertEquals(clients.retry_after(_response(503, headers={'Retry-After': '100000'})), clients.MAX_DELAY)
+        self.assertEquals(clients.retry_after(_response(503)), None)
+        self.assertEquals(clients.retry_after(_response(503, headers={'Retry-After': 'soon'})), None)
+        date = email.utils.formatdate(self.clock.now + 60, usegmt=True)
+        self.assertEquals(clients.retry_after(_response(503, headers={'Retry-After': date})), 60)
+        date = email.utils.formatdate(self.clock.now - 60, usegmt=True)
+        self.assertEquals(clients.retry_after(_response(503, headers={'Retry-After': date})), 0)
+
+    def test_retries(self):
+        session = mock.Mock()
+        session.get.side_effect = [_response(503, headers={'Retry-After': '5'}), requests.ConnectionError(),
+                                   _response(200, '<OAI-PMH/>')]
+        scheduler = clients.RequestScheduler(rate=4)
+        client = clients.PooledClient('http://localhost/oai', session=session, scheduler=scheduler,
+                                      max_retries=2, retry_backoff=1)
+        with mock.patch('ckanext.oaipmh.clients.random.uniform', side_effect=lambda low, high: high):
+            self.assertEquals(client.makeRequest(verb='Identify'), '<OAI-PMH/>')
+        self.assertEquals(session.get.call_count, 3)
+        self.assertEquals(session.get.call_args[1]['params'], {'verb': 'Identify'})
+        # Retry-After of the 503, then backoff of the second attempt. The
+        # 503 halved the rate and the success raised it a little.
+        self.assertEquals([delay for delay in self.clock.sleeps if delay >= 1], [5, 2])
+        self.assertAlmostEquals(scheduler.rate, 2.2)
+
+    def test_retries_exhausted(self):
+        session = mock.Mock()
+        session.get.side_effect = [_response(500), _response(500)]
+        client = clients.PooledClient('http://localhost/oai', session=session, max_retries=1, retry_backoff=1)
+        self.assertRaises(requests.HTTPError, client.makeRequest, verb='Identify')
+        self.assertEquals(session.get.call_count, 2)
+
+        session.get.side_effect = [_response(404)]
+        session.get.reset_mock()
+        self.assertRaises(requests.HTTPError, client.makeRequest, verb='Identify')
+        self.assertEquals(session.get.call_count, 1)
+
+
+class TestDeferredIndexing(TestCase):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+        oaipmh_model.setup()
+        cls.harvester = CMDIHarvester()
+
+    def tearDown(self):
+        ckan.model.repo.rebuild_db()
+
+    def _harvest_object(self, job, guid, content, package_id=None):
+        harvest_object = HarvestObject(guid=guid, job=job, source=job.source, content=content,
+                                       package_id=package_id, state=u'WAITING')
+        harvest_object.extras.append(HarvestObjectExtra(key=u'status', value=u'change'))
+        harvest_object.save()
+        return harvest_object
+
+    @mock.patch('ckanext.oaipmh.indexing.search')
+    def test_deleted_and_failed_objects(self, search):
+        if not model.User.get('harvest'):
+            model.User(name='harvest', sysadmin=True).save()
+        package = model.Package(name=u'oaipmh-deferred-test')
+        package.save()
+        source = HarvestSource(url=u'http://localhost/test_cmdi', type=u'cmdi',
+                               config=u'{"defer_indexing": true, "index_batch_size": 100}')
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+        deleted = self._harvest_object(job, u'oai:test:deleted',
+                                       _record_xml(u'oai:test:deleted', datetime.datetime(2017, 1, 1), deleted=True),
+                                       package_id=package.id)
+        broken = self._harvest_object(job, u'oai:test:broken', u'<record')
+
+        # The deleted package waits for the rest of the job
+        deleted.state = u'IMPORT'
+        self.assertTrue(self.harvester.import_stage(deleted))
+        self.assertEquals(self.harvester._get_object_extra(deleted, indexing.PENDING_KEY), u'true')
+        self.assertFalse(search.rebuild.called)
+
+        # The last object of the job fails, and the pending package is indexed anyway
+        broken.state = u'IMPORT'
+        broken.save()
+        self.assertFalse(self.harvester.import_stage(broken))
+        search.rebuild.assert_called_once_with(package.id, defer_commit=True)
+        model.Session.expire_all()
+        self.assertEquals(self.harvester._get_object_extra(HarvestObject.get(deleted.id), indexing.PENDING_KEY), None)
@@ -26,5 +26,8 @@ setup(
         cmdi_harvester=ckanext.oaipmh.cmdi:CMDIHarvester
         datacite_harvester=ckanext.oaipmh.datacite:DataCiteHarvester
         ddi25_harvester=ckanext.oaipmh.ddi25:Ddi25Harvester
+
+        [paste.paster_command]
+        oaipmh=ckanext.oaipmh.commands:OAIPMHCommand
         """,
 )